@@ -0,0 +1,66 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+"""Compare `Sum` and `ShardedSum` throughput as the number of writers grows.
+
+Each worker thread increments a shared counter `--iterations` times.  For
+each worker count this prints the aggregate increments/sec and the number of
+updates that were lost (expected total - observed total).
+
+Usage: python benchmarks/sharded_counters.py [--iterations N] [--workers ...]
+"""
+from __future__ import print_function
+
+from argparse import ArgumentParser
+from sparts.counters import Sum, ShardedSum
+from sparts.timer import Timer
+
+import threading
+
+
+def run(counter_cls, workers, iterations):
+    """Return (increments/sec, lost updates) for `workers` threads"""
+    counter = counter_cls()
+    start = threading.Event()
+
+    def work():
+        start.wait()
+        for i in range(iterations):
+            counter.increment()
+
+    threads = [threading.Thread(target=work) for i in range(workers)]
+    for t in threads:
+        t.start()
+
+    with Timer() as timer:
+        start.set()
+        for t in threads:
+            t.join()
+
+    expected = workers * iterations
+    return expected / timer.elapsed, expected - int(counter.getvalue())
+
+
+def main():
+    ap = ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--iterations', type=int, default=200000,
+                    help='Increments per worker thread [%(default)s]')
+    ap.add_argument('--workers', type=int, nargs='*',
+                    default=[1, 2, 4, 8, 16, 32],
+                    help='Worker thread counts to test [%(default)s]')
+    ns = ap.parse_args()
+
+    print('%8s %12s %14s %10s' % ('workers', 'counter', 'increments/s',
+                                  'lost'))
+    for workers in ns.workers:
+        for counter_cls in (Sum, ShardedSum):
+            rate, lost = run(counter_cls, workers, ns.iterations)
+            print('%8d %12s %14.0f %10d' % (workers, counter_cls.__name__,
+                                            rate, lost))
+
+
+if __name__ == '__main__':
+    main()
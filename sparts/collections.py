@@ -1,6 +1,13 @@
+from __future__ import absolute_import
+
 import heapq
+import threading
+import time
 
+from collections import namedtuple
+from six import next
 from six.moves.queue import Queue
+from sparts.compat import OrderedDict
 
 
 class PriorityQueue(Queue):
@@ -58,3 +65,79 @@ class UniqueQueue(Queue):
 
         with self.mutex:
             self._seen.remove(item)
+
+
+# Result of a cursor-based poll, e.g., `VService.getExportedValuesSince()`.
+# `values` maps changed keys to their values (None for removed keys), `cursor`
+# is passed to the next poll, and `full` is True if `values` is a complete
+# dump that should replace the caller's copy, rather than a delta.
+ChangeSet = namedtuple('ChangeSet', ['values', 'cursor', 'full'])
+
+
+class ChangeLog(object):
+    """Tracks the version at which each key last changed, for polling
+
+    Keys are kept ordered by that version, so finding what changed since a
+    cursor is O(keys changed), regardless of how many times they changed.
+    Removed keys are kept as tombstones, up to `max_tombstones` of them.
+    Beyond that, the oldest entries are forgotten, and cursors that predate
+    them must re-fetch everything.  Versions start at the current time in
+    microseconds, so cursors from before a restart are detected as stale."""
+    def __init__(self, max_tombstones=1024):
+        self.max_tombstones = max_tombstones
+        self._lock = threading.Lock()
+        # key -> (version, removed), oldest first
+        self._versions = OrderedDict()
+        self._tombstones = 0
+        self.version = self._floor = int(time.time() * 1000000)
+
+    def record(self, keys, removed=()):
+        """Records that `keys` changed and `removed` were removed.
+
+        Returns the new version."""
+        with self._lock:
+            self.version += 1
+            for key in keys:
+                self._set(key, False)
+            for key in removed:
+                self._set(key, True)
+            self._prune()
+            return self.version
+
+    def _set(self, key, removed):
+        """Moves `key` to the end, at the current version.  Requires `_lock`"""
+        entry = self._versions.pop(key, None)
+        if entry is not None and entry[1]:
+            self._tombstones -= 1
+        if removed:
+            self._tombstones += 1
+        self._versions[key] = (self.version, removed)
+
+    def _prune(self):
+        """Forgets the oldest entries while there are too many tombstones.
+
+        Requires `_lock`"""
+        versions = self._versions
+        while self._tombstones > self.max_tombstones:
+            key, (version, removed) = next(iter(versions.items()))
+            del versions[key]
+            if removed:
+                self._tombstones -= 1
+            self._floor = version
+
+    def changedSince(self, cursor):
+        """Returns (keys changed after `cursor`, current version).
+
+        keys is None if `cursor` is too old (or too new) to tell what
+        changed."""
+        with self._lock:
+            version = self.version
+            if cursor > version or cursor < self._floor:
+                return None, version
+
+            result = []
+            for key in reversed(self._versions):
+                if self._versions[key][0] <= cursor:
+                    break
+                result.append(key)
+            return result, version
@@ -32,6 +32,12 @@ except ImportError:
             raise subprocess.CalledProcessError(returncode, cmd=args, output=output)
         return output
 
+try:
+    from time import perf_counter
+except ImportError:
+    # Python2 compatibility; there is no monotonic clock in the stdlib
+    from time import time as perf_counter
+
 import logging
 import sys
 
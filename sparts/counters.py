@@ -8,12 +8,22 @@
 from __future__ import absolute_import
 
 from collections import deque
-from functools import partial
-from six import next
-from sparts.sparts import _Nameable, _Bindable, ProvidesCounters
-
+from functools import partial, wraps
+from heapq import heappop, heappush, heapreplace, merge
+from six import iteritems
+from sparts.deps import HAS_NUMPY
+from sparts.compat import OrderedDict, perf_counter
+from sparts.sparts import _Nameable, _Bindable, ProvidesCounters, \
+    ProvidesDynamicCounters
+
+import json
+import math
+import threading
 import time
 
+if HAS_NUMPY:
+    import numpy
+
 
 class SampleType:
     """Pass an array of these in the `types` paremeter to `sample()`"""
@@ -23,10 +33,16 @@ class SampleType:
     AVERAGE = 'avg'
     MAX = 'max'
     MIN = 'min'
+    P50 = 'p50'
+    P90 = 'p90'
+    P99 = 'p99'
+    P999 = 'p999'
+    RATE = 'rate'
 
 
 class _BaseCounter(_Nameable, _Bindable, ProvidesCounters):
     """Base type for counter-like things"""
+    __slots__ = ('name', '_bound')
     suffix = 'UNDEF'
 
     def __init__(self, name=None):
@@ -67,6 +83,7 @@ class _BaseCounter(_Nameable, _Bindable, ProvidesCounters):
 
 class ValueCounter(_BaseCounter):
     """Base type for counter-like things that have a `._value`"""
+    __slots__ = ('_value',)
     DEFAULT_VALUE = 0.0
     def _initialize(self, value=None):
         self._value = value or self.DEFAULT_VALUE
@@ -76,6 +93,8 @@ class ValueCounter(_BaseCounter):
 
 
 class CallbackCounter(_BaseCounter):
+    __slots__ = ('_callback',)
+
     def __init__(self, callback, name=None):
         super(CallbackCounter, self).__init__(name=name)
         self._callback = callback
@@ -87,13 +106,66 @@ class CallbackCounter(_BaseCounter):
         return self._callback()
 
 
+class _Batch(object):
+    """Accumulates updates locally, and applies them to `counter` in one go
+
+    Use as a context manager, which flushes on exit:
+
+        with self.n_completed.batch() as b:
+            for item in items:
+                b += 1
+    """
+    __slots__ = ('counter', )
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __iadd__(self, value):
+        self.add(value)
+        return self
+
+    def add(self, value):
+        raise NotImplementedError()
+
+    def flush(self):
+        raise NotImplementedError()
+
+
+class _SumBatch(_Batch):
+    """Sums updates locally, and adds the total to a `Sum` on `flush()`"""
+    __slots__ = ('value', )
+
+    def __init__(self, counter):
+        super(_SumBatch, self).__init__(counter)
+        self.value = 0
+
+    def add(self, value):
+        self.value += value
+
+    def flush(self):
+        value, self.value = self.value, 0
+        if value:
+            self.counter.add(value)
+
+
 class Sum(ValueCounter):
     """A running total"""
+    __slots__ = ()
     suffix = SampleType.SUM
 
     def add(self, value):
         self._value += value
 
+    def batch(self):
+        """Returns a `_Batch` accumulating `+=` updates to this counter"""
+        return _SumBatch(self)
+
     def increment(self):
         self.add(1.0)
 
@@ -105,8 +177,65 @@ class Sum(ValueCounter):
 
 counter = Sum
 
+
+class ShardedSum(Sum):
+    """A running total, accumulated in per-thread shards
+
+    Each thread only ever updates its own shard, so `add`s from many worker
+    threads neither contend on shared state nor lose updates.  The shards are
+    summed lazily when the value is read, and the shards of threads that have
+    exited are folded into a base value at that point.
+    """
+    __slots__ = ('_base', '_local', '_shards', '_lock')
+
+    def _initialize(self, value=None):
+        self._base = value or self.DEFAULT_VALUE
+        self._local = threading.local()
+        # (thread, shard) for each thread that has updated the counter
+        self._shards = []
+        # Not taken by `add`, once the calling thread has its shard
+        self._lock = threading.Lock()
+
+    def _newShard(self):
+        """Create and register the calling thread's shard"""
+        shard = self._local.shard = [0.0]
+        with self._lock:
+            self._fold()
+            self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _fold(self):
+        """Fold the shards of exited threads into `_base`.  Requires `_lock`"""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._base += shard[0]
+        self._shards = live
+
+    def add(self, value):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._newShard()
+        shard[0] += value
+
+    def getvalue(self):
+        with self._lock:
+            self._fold()
+            return self._base + sum(shard[0] for _, shard in self._shards)
+
+    def reset(self, value=0):
+        with self._lock:
+            self._fold()
+            self._base = value - sum(shard[0] for _, shard in self._shards)
+
+sharded_counter = ShardedSum
+
 class Count(ValueCounter):
     """A running count"""
+    __slots__ = ()
     suffix = SampleType.COUNT
     DEFAULT_VALUE = 0
 
@@ -115,6 +244,7 @@ class Count(ValueCounter):
 
 class Average(_BaseCounter):
     """A running average"""
+    __slots__ = ('_total', '_count')
     suffix = SampleType.AVERAGE
 
     def _initialize(self):
@@ -135,6 +265,7 @@ class Average(_BaseCounter):
 
 class Max(ValueCounter):
     """A running maximum"""
+    __slots__ = ()
     suffix = SampleType.MAX
     DEFAULT_VALUE = None
 
@@ -147,6 +278,7 @@ class Max(ValueCounter):
 
 class Min(ValueCounter):
     """A running minimum"""
+    __slots__ = ()
     suffix = SampleType.MIN
     DEFAULT_VALUE = None
 
@@ -159,121 +291,1434 @@ class Min(ValueCounter):
     def getvalue(self):
         return self._value
 
-# TODO: Percentiles!!
+
+class _Histogram(object):
+    """Log-bucketed histogram used to estimate percentiles in fixed memory.
+
+    Values are assigned to buckets whose bounds grow geometrically by
+    `GROWTH`, so estimates are within ~1% of the true value, and memory is
+    bounded by the dynamic range of the values rather than their number.
+    """
+    __slots__ = ('count', 'zeros', 'positive', 'negative')
+    GROWTH = 1.02
+    _LOG_GROWTH = math.log(GROWTH)
+
+    def __init__(self):
+        self.count = 0
+        self.zeros = 0
+        self.positive = {}
+        self.negative = {}
+
+    def _bucketFor(self, value):
+        """Return the (buckets, key) pair that `value` should be counted in"""
+        if value > 0:
+            return self.positive, int(math.floor(math.log(value) /
+                                                 self._LOG_GROWTH))
+        elif value < 0:
+            return self.negative, int(math.floor(math.log(-value) /
+                                                 self._LOG_GROWTH))
+        return None, None
+
+    def add(self, value, count=1):
+        self.count += count
+        buckets, key = self._bucketFor(value)
+        if buckets is None:
+            self.zeros += count
+        else:
+            buckets[key] = buckets.get(key, 0) + count
+
+    def remove(self, value, count=1):
+        """Remove `count` previously added occurrences of `value`"""
+        self.count -= count
+        buckets, key = self._bucketFor(value)
+        if buckets is None:
+            self.zeros -= count
+        else:
+            self._decrement(buckets, key, count)
+
+    def _decrement(self, buckets, key, count):
+        remaining = buckets[key] - count
+        if remaining > 0:
+            buckets[key] = remaining
+        else:
+            del buckets[key]
+
+    def merge(self, histogram):
+        """Add all the counts of `histogram`"""
+        self.count += histogram.count
+        self.zeros += histogram.zeros
+        for mine, theirs in ((self.positive, histogram.positive),
+                             (self.negative, histogram.negative)):
+            for key, count in iteritems(theirs):
+                mine[key] = mine.get(key, 0) + count
+
+    def subtract(self, histogram):
+        """Remove the counts of a previously merged `histogram`"""
+        self.count -= histogram.count
+        self.zeros -= histogram.zeros
+        for mine, theirs in ((self.positive, histogram.positive),
+                             (self.negative, histogram.negative)):
+            for key, count in iteritems(theirs):
+                self._decrement(mine, key, count)
+
+    def _iterbuckets(self):
+        """Yield (representative value, count) in ascending value order"""
+        for key in sorted(self.negative, reverse=True):
+            yield -self.GROWTH ** (key + 0.5), self.negative[key]
+        if self.zeros:
+            yield 0.0, self.zeros
+        for key in sorted(self.positive):
+            yield self.GROWTH ** (key + 0.5), self.positive[key]
+
+    def quantile(self, q):
+        """Return the estimated value at quantile `q` (0.0 - 1.0), or None"""
+        if self.count <= 0:
+            return None
+
+        # Nearest-rank method
+        rank = max(1, int(math.ceil(q * self.count)))
+        seen = 0
+        for value, count in self._iterbuckets():
+            seen += count
+            if seen >= rank:
+                return value
+        return value
+
+
+class Percentile(_BaseCounter):
+    """A running percentile estimate (e.g., `Percentile(0.99)` for p99)"""
+    __slots__ = ('percentile', 'suffix', '_histogram')
+
+    def __init__(self, percentile=0.5, name=None):
+        self.percentile = percentile
+        self.suffix = 'p' + ('%g' % (percentile * 100)).replace('.', '')
+        super(Percentile, self).__init__(name)
+
+    def _bind(self, obj):
+        return self.__class__(percentile=self.percentile, name=self.name)
+
+    def _initialize(self):
+        self._histogram = _Histogram()
+
+    def add(self, value):
+        self._histogram.add(value)
+
+    def getvalue(self):
+        return self._histogram.quantile(self.percentile)
 
 
-# Lookup for mapping SampleTypes to their respective classes
-_SampleMethod = {
-    SampleType.COUNT: Count,
-    SampleType.SUM: Sum,
-    SampleType.AVERAGE: Average,
-    SampleType.MAX: Max,
-    SampleType.MIN: Min,
+# Lookup for mapping percentile SampleTypes to their quantiles
+_SamplePercentile = {
+    SampleType.P50: 0.5,
+    SampleType.P90: 0.9,
+    SampleType.P99: 0.99,
+    SampleType.P999: 0.999,
 }
 
 
+class _SamplesBatch(_Batch):
+    """Collects values locally, and `add_many()`s them on `flush()`"""
+    __slots__ = ('values', )
+
+    def __init__(self, counter):
+        super(_SamplesBatch, self).__init__(counter)
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+
+    def flush(self):
+        values, self.values = self.values, []
+        if values:
+            self.counter.add_many(values)
+
+
+class _SampleTimer(object):
+    """Per-thread, reentrant context manager behind `Samples.time()`"""
+    __slots__ = ('samples', 'pending', 'errors', 'starts')
+
+    def __init__(self, samples):
+        self.samples = samples
+        # Set by `time()`, consumed by the next `__enter__`, so a `time()`
+        # that is never entered can't leave a stale entry on the stack
+        self.pending = None
+        # Stacks, one entry per nested (or recursive) `with` block
+        self.errors = []
+        self.starts = []
+
+    def __enter__(self):
+        self.errors.append(self.pending)
+        self.pending = None
+        self.starts.append(perf_counter())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = perf_counter() - self.starts.pop()
+        errors = self.errors.pop()
+        self.samples.add(elapsed * 1000.0)
+        if exc_type is not None and errors is not None:
+            errors.increment()
+
+
+def timed(samples_attr, errors_attr=None):
+    """Decorator that adds each call's duration (in ms) to `samples_attr`
+
+    For example, on a task with `parse_ms = samples(...)`, `@timed('parse_ms',
+    'n_parse_errors')` times each call into `self.parse_ms`, and counts the
+    calls that raise in `self.n_parse_errors`.  Include SampleType.COUNT in
+    the samples' types to export the number of calls."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            start = perf_counter()
+            try:
+                return f(self, *args, **kwargs)
+            except Exception:
+                if errors_attr is not None:
+                    getattr(self, errors_attr).increment()
+                raise
+            finally:
+                getattr(self, samples_attr).add(
+                    (perf_counter() - start) * 1000.0)
+        return wrapper
+    return decorator
+
+
+class _SampleBucket(object):
+    """Pre-aggregated summary of all the samples added during an interval"""
+    __slots__ = ('ts', 'count', 'total', 'min', 'max', 'histogram')
+
+    def __init__(self, ts, histogram=False):
+        self.ts = ts
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+        self.histogram = _Histogram() if histogram else None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if self.histogram is not None:
+            self.histogram.add(value)
+
+    def merge(self, bucket):
+        """Add all the samples summarized by `bucket`"""
+        self.count += bucket.count
+        self.total += bucket.total
+        if self.min is None or bucket.min < self.min:
+            self.min = bucket.min
+        if self.max is None or bucket.max > self.max:
+            self.max = bucket.max
+        if self.histogram is not None:
+            self.histogram.merge(bucket.histogram)
+
+
+class _LocalBuckets(object):
+    """A thread's `_SampleBucket`s, not yet merged into a `Samples`' windows"""
+    __slots__ = ('lock', 'bucket', 'pending')
+
+    def __init__(self):
+        # Only contended while the buckets are being taken
+        self.lock = threading.Lock()
+        self.bucket = None
+        self.pending = []
+
+    def bucketFor(self, ts, histogram):
+        """Return the bucket starting at `ts`.  Requires `lock`"""
+        bucket = self.bucket
+        if bucket is None or bucket.ts != ts:
+            bucket = self.bucket = _SampleBucket(ts, histogram)
+            self.pending.append(bucket)
+        return bucket
+
+    def take(self):
+        """Return the pending buckets, and start afresh"""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.bucket = None
+        return pending
+
+
+class _SampleWindow(object):
+    """Running aggregates over the samples within a single `Samples` window
+
+    Values are added as they arrive and subtracted as the entries holding
+    them expire, so reads are O(1) (O(histogram buckets) for percentiles)
+    regardless of how many samples are in the window.  MIN/MAX are tracked
+    with monotonic deques of (ts, value) that hold at most one entry per
+    timestamp (or bucket).
+    """
+    __slots__ = ('window', 'resolution', 'entries', 'count', 'total', 'mins',
+                 'maxes', 'histogram', 'current')
+
+    def __init__(self, window, types, resolution=None):
+        self.window = window
+        self.resolution = resolution
+        # In bucketed mode, the start of the bucket that is still filling
+        self.current = None
+        # Raw (ts, value) tuples, or `_SampleBucket`s in bucketed mode
+        self.entries = deque()
+        self.count = 0
+        self.total = 0.0
+        self.mins = deque() if SampleType.MIN in types else None
+        self.maxes = deque() if SampleType.MAX in types else None
+        self.histogram = None
+        if any(type in _SamplePercentile for type in types):
+            self.histogram = _Histogram()
+
+    def add(self, ts, value, entry=None):
+        """Add `value` at `ts`, tracking `entry` (if any) for expiry"""
+        if entry is not None:
+            self.entries.append(entry)
+        self.count += 1
+        self.total += value
+        if self.histogram is not None:
+            self.histogram.add(value)
+        self._addExtremes(ts, value, value)
+
+    def addBucket(self, ts, bucket, entry=None):
+        """Add the samples in `bucket` at `ts`, tracking `entry` for expiry"""
+        if entry is not None:
+            self.entries.append(entry)
+        self.count += bucket.count
+        self.total += bucket.total
+        if self.histogram is not None:
+            self.histogram.merge(bucket.histogram)
+        self._addExtremes(ts, bucket.min, bucket.max)
+
+    def _addExtremes(self, ts, low, high):
+        maxes = self.maxes
+        if maxes is not None:
+            while maxes and maxes[-1][1] <= high:
+                maxes.pop()
+            if not maxes or maxes[-1][0] != ts:
+                maxes.append((ts, high))
+
+        mins = self.mins
+        if mins is not None:
+            while mins and mins[-1][1] >= low:
+                mins.pop()
+            if not mins or mins[-1][0] != ts:
+                mins.append((ts, low))
+
+    def expire(self, now):
+        """Subtract all entries that have fallen out of the window at `now`
+
+        In bucketed mode, the window holds the complete buckets that fit in
+        it, plus the one still filling at `now`."""
+        cutoff = now - self.window
+        if self.resolution is not None:
+            self.current = now - now % self.resolution
+            cutoff = self.current - self.window
+        entries = self.entries
+        histogram = self.histogram
+        while entries:
+            entry = entries[0]
+            if isinstance(entry, _SampleBucket):
+                if cutoff <= entry.ts:
+                    break
+                self.count -= entry.count
+                self.total -= entry.total
+                if histogram is not None:
+                    histogram.subtract(entry.histogram)
+            else:
+                ts, value = entry
+                if cutoff <= ts:
+                    break
+                self.count -= 1
+                self.total -= value
+                if histogram is not None:
+                    histogram.remove(value)
+            entries.popleft()
+
+        # Don't let floating point error accumulate across empty periods
+        if self.count == 0:
+            self.total = 0.0
+
+        for extremes in (self.mins, self.maxes):
+            while extremes and cutoff > extremes[0][0]:
+                extremes.popleft()
+
+    def getvalue(self, type):
+        """Return the value of the `SampleType`, `type`, for this window"""
+        if type == SampleType.COUNT:
+            return self.count
+        elif type == SampleType.SUM:
+            return self.total
+        elif type == SampleType.AVERAGE:
+            if self.count == 0:
+                return None
+            return self.total / self.count
+        elif type == SampleType.MAX:
+            return self.maxes[0][1] if self.maxes else None
+        elif type == SampleType.MIN:
+            return self.mins[0][1] if self.mins else None
+        elif type == SampleType.RATE:
+            return self._rate()
+        return self.histogram.quantile(_SamplePercentile[type])
+
+    def _rate(self):
+        """Return the per-second rate of the values in the window
+
+        In bucketed mode, the bucket still filling is left out, and the total
+        of the complete buckets is divided by the time they span.  Otherwise,
+        the rate would swing by up to a bucket's worth with the phase."""
+        if self.resolution is None:
+            return self.total / float(self.window)
+        total = self.total
+        entries = self.entries
+        if entries and entries[-1].ts >= self.current:
+            total -= entries[-1].total
+        return total / float(self.window - self.window % self.resolution)
+
+
+class _AllTimeWindow(_SampleWindow):
+    """Running aggregates over every sample ever added.  Retains nothing."""
+    __slots__ = ('min', 'max')
+
+    def __init__(self, types):
+        super(_AllTimeWindow, self).__init__(None, types)
+        self.min = self.max = None
+
+    def add(self, ts, value, entry=None):
+        self.count += 1
+        self.total += value
+        if self.histogram is not None:
+            self.histogram.add(value)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def addBucket(self, ts, bucket, entry=None):
+        self.count += bucket.count
+        self.total += bucket.total
+        if self.histogram is not None:
+            self.histogram.merge(bucket.histogram)
+        if self.min is None or bucket.min < self.min:
+            self.min = bucket.min
+        if self.max is None or bucket.max > self.max:
+            self.max = bucket.max
+
+    def expire(self, now):
+        pass
+
+    def getvalue(self, type):
+        if type == SampleType.MAX:
+            return self.max
+        elif type == SampleType.MIN:
+            return self.min
+        elif type == SampleType.RATE:
+            # There is no meaningful duration to divide by
+            return None
+        return super(_AllTimeWindow, self).getvalue(type)
+
+
 class Samples(_Nameable, _Bindable, ProvidesCounters):
     """`samples` are used to generate series of counters dynamically
 
     This is so you can say, keep track of the average duration of some event for
     the last minute, hour, day, etc, and export these as 4 separate counters.
+
+    A window of `None` tracks all samples ever added, and is exported without
+    a window suffix (e.g., `foo.avg`).  It is maintained as running
+    aggregates, and does not retain any samples.
+
+    By default, every sample is retained until it falls out of the largest
+    window.  Pass `resolution` (seconds) to instead pre-aggregate samples into
+    `resolution`-second buckets.  This bounds memory to
+    O(max window / resolution), at the cost of windows only being accurate to
+    within `resolution` seconds.
+
+    Each window's aggregates are maintained incrementally as samples are
+    added and expire, so reading counters does not scan the samples.
+
+    `add` is safe to call from many threads.  Each thread appends to its own
+    buffer, which is merged into the windows when counters are read, or once
+    it holds `FLUSH_SIZE` samples.  Merged timestamps are clamped to be
+    non-decreasing, so a sample may be counted up to one flush late.  In
+    bucketed mode, each thread instead aggregates into its own bucket, so
+    adding a sample does not allocate.  These are merged when counters are
+    read, or when the thread starts its next bucket.
     """
-    def __init__(self, types=None, windows=None, name=None):
+    __slots__ = ('name', '_bound', 'types', 'windows', 'max_window',
+                 'all_time', 'resolution', '_windows', '_windows_by_name',
+                 '_histogram', '_bucket', '_samples', '_all_time', '_local',
+                 '_buffers', '_last', '_lock', '_now')
+    FLUSH_SIZE = 256
+
+    def __init__(self, types=None, windows=None, name=None, resolution=None):
         super(Samples, self).__init__(name)
         self.types = types or [SampleType.AVERAGE]
+        windows = windows or [60, 3600]
         # minutely, hourly
-        self.windows = sorted(windows or [60, 3600])
-        self.max_window = max(self.windows)
-        self.samples = deque()
-        self.dirty = True
-        self._prev_counters = {}
-        self._prev_time = None
+        self.windows = sorted(w for w in windows if w is not None)
+        self.max_window = max(self.windows) if self.windows else None
+        self.all_time = None in windows
+        self.resolution = resolution
+        assert resolution is None or not self.windows or \
+            self.windows[0] >= resolution, \
+            "windows must not be smaller than resolution (%s)" % resolution
+
+        self._windows = [_SampleWindow(window, self.types, resolution)
+                         for window in self.windows]
+        self._windows_by_name = dict((str(w.window), w)
+                                     for w in self._windows)
+        self._histogram = any(type in _SamplePercentile
+                              for type in self.types)
+        self._bucket = None
+        # Defined to allow unittest overriding
+        self._now = time.time
+
+        # The largest window retains every sample (or bucket)
+        if self._windows:
+            self._samples = self._windows[-1].entries
+        else:
+            self._samples = deque()
+
+        self._all_time = None
+        if self.all_time:
+            self._all_time = _AllTimeWindow(self.types)
+            self._windows.append(self._all_time)
+
+        # Per-thread buffers of (ts, value), and their threads
+        self._local = threading.local()
+        self._buffers = []
+        self._last = None
+        # Guards the windows.  Not taken by `add` until a buffer is full.
+        self._lock = threading.Lock()
 
     def _bind(self, obj):
-        return self.__class__(types=self.types, windows=self.windows,
-                              name=self.name)
+        windows = self.windows
+        if self.all_time:
+            windows = windows + [None]
+        return self.__class__(types=self.types, windows=windows,
+                              name=self.name, resolution=self.resolution)
 
     def _genCounterCallbacks(self):
         """Yield all the child counters."""
         for subcounter in self.iterkeys():
             yield subcounter, partial(self.getCounter, subcounter)
 
-    def _now(self):
-        """Defined to allow unittest overriding"""
-        return time.time()
+    @property
+    def samples(self):
+        """The samples (or buckets) retained for the largest window"""
+        self._flush()
+        return self._samples
 
     def add(self, value):
         now = self._now()
-        self.samples.append((now, value))
-
-        # When adding samples, trim old ones.
-        while now - self.max_window > self.samples[0][0]:
-            self.samples.popleft()
-        self.dirty = True
-
-        # TODO: Handle "infinite" windows
+        if self.resolution is not None:
+            buckets = self._localBuckets()
+            with buckets.lock:
+                buckets.bucketFor(now - now % self.resolution,
+                                  self._histogram).add(value)
+                n = len(buckets.pending)
+            if n > 1:
+                self._flush()
+            return
+
+        try:
+            buffer = self._local.buffer
+        except AttributeError:
+            buffer = self._newBuffer()
+        buffer.append((now, value))
+        if len(buffer) >= self.FLUSH_SIZE:
+            self._flush()
+
+    def add_many(self, values):
+        """Add all `values`, with a single timestamp
+
+        Cheaper than calling `add()` for each value from a hot loop."""
+        now = self._now()
+        if self.resolution is not None:
+            buckets = self._localBuckets()
+            with buckets.lock:
+                bucket = buckets.bucketFor(now - now % self.resolution,
+                                           self._histogram)
+                for value in values:
+                    bucket.add(value)
+                n = len(buckets.pending)
+            if n > 1:
+                self._flush()
+            return
+
+        try:
+            buffer = self._local.buffer
+        except AttributeError:
+            buffer = self._newBuffer()
+        buffer.extend([(now, value) for value in values])
+        if len(buffer) >= self.FLUSH_SIZE:
+            self._flush()
+
+    def batch(self):
+        """Returns a `_Batch` collecting `+=`ed values for `add_many()`"""
+        return _SamplesBatch(self)
+
+    def time(self, errors=None):
+        """Returns a context manager that adds its duration (in ms) as a sample
+
+        If the block raises, `errors` (e.g., a `counter()`) is incremented.
+        The context manager is per-thread and reused, so timing a block does
+        not allocate a `Timer`; enter it right away, as in
+        `with samples.time(errors):`."""
+        try:
+            timer = self._local.timer
+        except AttributeError:
+            timer = self._local.timer = _SampleTimer(self)
+        timer.pending = errors
+        return timer
+
+    def _newBuffer(self):
+        """Create and register the calling thread's sample buffer"""
+        buffer = self._local.buffer = []
+        with self._lock:
+            self._buffers.append((threading.current_thread(), buffer))
+        return buffer
+
+    def _localBuckets(self):
+        """Return the calling thread's `_LocalBuckets`, registering it"""
+        try:
+            return self._local.buckets
+        except AttributeError:
+            buckets = self._local.buckets = _LocalBuckets()
+            with self._lock:
+                self._buffers.append((threading.current_thread(), buckets))
+            return buckets
+
+    def _flush(self):
+        with self._lock:
+            self._drain()
+
+    def _drain(self):
+        """Merge all buffered samples into the windows.  Requires `_lock`"""
+        if self.resolution is not None:
+            self._drainBuckets()
+            return
+
+        batches = []
+        live = []
+        for thread, buffer in self._buffers:
+            # Check before draining, so an exited thread's buffer is complete
+            if thread.is_alive():
+                live.append((thread, buffer))
+            # Writers may append concurrently, so only remove what we copied
+            n = len(buffer)
+            if n:
+                batches.append(buffer[:n])
+                del buffer[:n]
+
+        # Forget the (now empty) buffers of threads that have exited
+        self._buffers = live
+
+        if not batches:
+            return
+        elif len(batches) == 1:
+            pending = batches[0]
+        else:
+            pending = merge(*batches)
+
+        last = self._last
+        for now, value in pending:
+            if last is not None and now < last:
+                now = last
+            last = now
+            self._record(now, value)
+        self._last = last
+
+    def _record(self, now, value):
+        """Add `value` to all the windows.  Requires `_lock`"""
+        entry = (now, value)
+        for window in self._windows:
+            # When adding samples, trim old ones.
+            window.expire(now)
+            window.add(now, value, entry)
+
+    def _drainBuckets(self):
+        """Merge all threads' buckets into the windows.  Requires `_lock`"""
+        pending = []
+        live = []
+        for thread, buckets in self._buffers:
+            # Check before draining, so an exited thread's buckets are complete
+            if thread.is_alive():
+                live.append((thread, buckets))
+            # (`add_many` may have started a bucket with no values)
+            pending.extend(bucket for bucket in buckets.take()
+                           if bucket.count)
+
+        # Forget the (now empty) buckets of threads that have exited
+        self._buffers = live
+
+        pending.sort(key=lambda bucket: bucket.ts)
+        for bucket in pending:
+            self._recordBucket(bucket)
+
+    def _recordBucket(self, bucket):
+        """Add a thread's `bucket` to all the windows.  Requires `_lock`
+
+        Only tracks a new entry in the windows when a new bucket is started.
+        Buckets for earlier intervals are clamped into the current one."""
+        current = self._bucket
+        if current is not None and bucket.ts <= current.ts:
+            current.merge(bucket)
+            ts, entry = current.ts, None
+        else:
+            ts, entry = bucket.ts, bucket
+            self._bucket = bucket
+
+        for window in self._windows:
+            # When adding samples, trim old ones.
+            window.expire(ts)
+            window.addBucket(ts, bucket, entry)
+
+    def _counterName(self, type, window):
+        name = type
+        if window is not None:
+            name += '.' + str(window)
+        if self.name is not None:
+            name = self.name + '.' + name
+        return name
 
     def getCounters(self):
-        if self.dirty is False and self._prev_time == int(self._now()):
-            return self._prev_counters
+        now = self._now()
+        result = {}
+        with self._lock:
+            self._drain()
+            for window in self._windows:
+                window.expire(now)
+                for type in self.types:
+                    result[self._counterName(type, window.window)] = \
+                        window.getvalue(type)
+        return result
 
-        ops = []
+    def getCounter(self, name, default=None):
+        head, _, suffix = name.rpartition('.')
+        window = self._windows_by_name.get(suffix)
+        if window is not None:
+            _, _, type = head.rpartition('.')
+        else:
+            # Names without a window suffix are for the all-time window
+            window, type = self._all_time, suffix
+        if window is None or type not in self.types:
+            return default
+        with self._lock:
+            self._drain()
+            window.expire(self._now())
+            return window.getvalue(type)
+
+    def iterkeys(self):
         for type in self.types:
-            ops.append(_SampleMethod[type]())
+            for window in self.windows:
+                yield self._counterName(type, window)
+            if self.all_time:
+                yield self._counterName(type, None)
+
+    def _genCounterSeries(self):
+        """Yields each type as one series, labelled by `window`."""
+        windows = list(self.windows)
+        if self.all_time:
+            windows.append(None)
+        for type in self.types:
+            for window in windows:
+                labels = {'window': 'all' if window is None else str(window)}
+                yield (self._counterName(type, None), labels,
+                       partial(self.getCounter,
+                               self._counterName(type, window)))
+
+
+class NumpySamples(Samples):
+    """`Samples` stored in preallocated circular numpy arrays
+
+    Timestamps and values are kept in `float64` ring buffers, and each
+    window is reduced with a vectorized mask (and `numpy.percentile`) when
+    counters are read.  Recording a buffered sample into the ring is O(1)
+    and allocation free, except when the ring is full of unexpired samples
+    and has to grow.
+
+    Percentiles are exact rather than histogram estimates.  The all-time
+    window, if requested, is kept as running aggregates.
+    """
+    __slots__ = ('capacity', '_ts', '_values', '_start', '_size')
+
+    def __init__(self, types=None, windows=None, name=None, resolution=None,
+                 capacity=4096):
+        if not HAS_NUMPY:
+            raise Exception("Need `numpy` to use backend='numpy'")
+        assert resolution is None, "numpy backend does not take resolution"
+        self.capacity = capacity
+        super(NumpySamples, self).__init__(types=types, windows=windows,
+                                           name=name)
+        # The ring replaces the per-window aggregates
+        self._windows = [self._all_time] if self.all_time else []
+        self._ts = numpy.zeros(capacity, dtype=numpy.float64)
+        self._values = numpy.zeros(capacity, dtype=numpy.float64)
+        self._start = 0
+        self._size = 0
+        self._samples = None
+
+    def _bind(self, obj):
+        windows = self.windows
+        if self.all_time:
+            windows = windows + [None]
+        return self.__class__(types=self.types, windows=windows,
+                              name=self.name, capacity=self.capacity)
+
+    def _ordered(self):
+        """Return (timestamps, values) of retained samples, oldest first"""
+        end = self._start + self._size
+        if end <= len(self._ts):
+            return (self._ts[self._start:end],
+                    self._values[self._start:end])
+        end -= len(self._ts)
+        return (numpy.concatenate((self._ts[self._start:], self._ts[:end])),
+                numpy.concatenate((self._values[self._start:],
+                                   self._values[:end])))
+
+    def _trim(self, now):
+        """Drop samples that have fallen out of the largest window"""
+        if self.max_window is None:
+            self._size = 0
+            return
+        ts, _ = self._ordered()
+        expired = int(numpy.searchsorted(ts, now - self.max_window))
+        self._start = (self._start + expired) % len(self._ts)
+        self._size -= expired
+
+    def _grow(self):
+        ts, values = self._ordered()
+        capacity = len(self._ts) * 2
+        self._ts = numpy.zeros(capacity, dtype=numpy.float64)
+        self._values = numpy.zeros(capacity, dtype=numpy.float64)
+        self._ts[:self._size] = ts
+        self._values[:self._size] = values
+        self._start = 0
+
+    def _record(self, now, value):
+        if self._all_time is not None:
+            self._all_time.add(now, value)
+        if self.max_window is None:
+            return
+
+        if self._size == len(self._ts):
+            self._trim(now)
+            if self._size == len(self._ts):
+                self._grow()
+
+        index = (self._start + self._size) % len(self._ts)
+        self._ts[index] = now
+        self._values[index] = value
+        self._size += 1
+
+    def _reduce(self, values, type, window):
+        """Return the value of the `SampleType`, `type`, for `values`"""
+        if type == SampleType.COUNT:
+            return len(values)
+        elif type == SampleType.SUM:
+            return float(values.sum())
+        elif type == SampleType.RATE:
+            return float(values.sum()) / window
+        elif len(values) == 0:
+            return None
+        elif type == SampleType.AVERAGE:
+            return float(values.mean())
+        elif type == SampleType.MAX:
+            return float(values.max())
+        elif type == SampleType.MIN:
+            return float(values.min())
+        return float(numpy.percentile(values,
+                                      _SamplePercentile[type] * 100))
+
+    def _windowValues(self, ts, values, now, window):
+        return values[ts >= now - window]
 
+    def getCounters(self):
         now = self._now()
-        genwindows = iter(self.windows)
-        window = next(genwindows)
         result = {}
-        done = False
+        with self._lock:
+            self._drain()
+            if self._all_time is not None:
+                for type in self.types:
+                    result[self._counterName(type, None)] = \
+                        self._all_time.getvalue(type)
+
+            if self.windows:
+                ts, values = self._ordered()
+                for window in self.windows:
+                    windowed = self._windowValues(ts, values, now, window)
+                    for type in self.types:
+                        result[self._counterName(type, window)] = \
+                            self._reduce(windowed, type, window)
+        return result
 
-        def _saveCounterValues(window):
-            """Re-usable helper function for setting results and continuing"""
+    def getCounter(self, name, default=None):
+        head, _, suffix = name.rpartition('.')
+        if suffix in self._windows_by_name:
+            window = self._windows_by_name[suffix].window
+            _, _, type = head.rpartition('.')
+        else:
+            window, type = None, suffix
+            if self._all_time is None:
+                return default
+        if type not in self.types:
+            return default
+
+        with self._lock:
+            self._drain()
+            if window is None:
+                return self._all_time.getvalue(type)
+            ts, values = self._ordered()
+            windowed = self._windowValues(ts, values, self._now(), window)
+            return self._reduce(windowed, type, window)
+
+
+# Lookup for mapping `samples()` backends to their respective classes
+_SampleBackend = {
+    'python': Samples,
+    'numpy': NumpySamples,
+}
 
-            prefix = ''
-            if self.name is not None:
-                prefix = self.name + '.'
 
-            for op in ops:
-                result[prefix + op.suffix + '.' + str(window)] = \
-                    op.getvalue()
-            # Move to the next window
-            try:
-                return next(genwindows), False
-            except StopIteration:
-                # We exhausted all our windows
-                return None, True
-
-        for ts, value in reversed(self.samples):
-            # We exceeded the current window
-            while not done and now - window > ts:
-                # Save counter values
-                window, done = _saveCounterValues(window)
-
-            if done:
-                # TODO: "prune" any remaining samples
-                break
-
-            for op in ops:
-                op.add(value)
-
-        # We exhausted the samples before the windows
-        while not done:
-            window, done = _saveCounterValues(window)
-
-        self._prev_counters = result
-        self._prev_time = int(now)
-        self.dirty = False
+def samples(types=None, windows=None, name=None, backend='python', **kwargs):
+    """Declare a `Samples` counter series using the given `backend`
+
+    `backend` may be 'python' (the default) or 'numpy'.  Extra `kwargs` are
+    passed to the backend class (e.g., `resolution` or `capacity`)."""
+    return _SampleBackend[backend](types=types, windows=windows, name=name,
+                                   **kwargs)
+
+
+class Rate(Samples):
+    """The per-second rate of the values `add`ed over each window
+
+    For example, `requests = rate(windows=[60])` exports `requests.rate.60`
+    as requests/sec.  Values are folded into one-second buckets, so memory is
+    O(max window) regardless of the event rate.  Rates are over the complete
+    buckets, so they lag by up to one `resolution`.
+    """
+    __slots__ = ()
+
+    def __init__(self, windows=None, name=None, resolution=1):
+        super(Rate, self).__init__(types=[SampleType.RATE], windows=windows,
+                                   name=name, resolution=resolution)
+
+    def _bind(self, obj):
+        return self.__class__(windows=self.windows, name=self.name,
+                              resolution=self.resolution)
+
+    def increment(self):
+        self.add(1.0)
+
+    def incrementBy(self, value):
+        self.add(value)
+
+rate = Rate
+
+
+class EWMA(_Nameable, _Bindable, ProvidesCounters):
+    """Exponentially weighted moving averages of the values `add`ed
+
+    One average is kept per half-life (seconds), similar to load averages.
+    Each is O(1) memory and O(1) to update, and is exported as e.g.
+    `foo.ewma.60`.  Each sample counts once, and its weight halves every
+    `half_life` seconds, so samples sharing a timestamp are all counted, and
+    a lone sample after an idle period doesn't replace the average.
+    """
+    __slots__ = ('name', '_bound', 'half_lives', '_sums', '_weights',
+                 '_last', '_now', '_lock')
+    suffix = 'ewma'
+
+    def __init__(self, half_lives=None, name=None):
+        super(EWMA, self).__init__(name)
+        self.half_lives = sorted(half_lives or [60, 300, 900])
+        # Per half-life, the decayed sum of the values, and of their weights
+        self._sums = [0.0] * len(self.half_lives)
+        self._weights = [0.0] * len(self.half_lives)
+        self._last = None
+        self._lock = threading.Lock()
+        # Defined to allow unittest overriding
+        self._now = time.time
+
+    def _bind(self, obj):
+        return self.__class__(half_lives=self.half_lives, name=self.name)
+
+    def _decay(self, elapsed, half_life):
+        """Return the weight remaining after `elapsed` seconds"""
+        return 0.5 ** (elapsed / float(half_life))
+
+    def _decayTo(self, now):
+        """Decay the sums and weights to `now`.  Requires `_lock`"""
+        if self._last is not None and now > self._last:
+            elapsed = now - self._last
+            for i, half_life in enumerate(self.half_lives):
+                weight = self._decay(elapsed, half_life)
+                self._sums[i] *= weight
+                self._weights[i] *= weight
+        if self._last is None or now > self._last:
+            self._last = now
+
+    def add(self, value):
+        now = self._now()
+        with self._lock:
+            self._decayTo(now)
+            for i in range(len(self._sums)):
+                self._sums[i] += value
+                self._weights[i] += 1.0
+
+    def getvalue(self, half_life):
+        i = self.half_lives.index(half_life)
+        with self._lock:
+            # Decaying both alike doesn't change the average
+            if not self._weights[i]:
+                return None
+            return self._sums[i] / self._weights[i]
+
+    def _genCounterCallbacks(self):
+        """Yield all the child counters."""
+        for subcounter in self.iterkeys():
+            yield subcounter, partial(self.getCounter, subcounter)
+
+    def getCounters(self):
+        result = {}
+        for name, half_life in zip(self.iterkeys(), self.half_lives):
+            result[name] = self.getvalue(half_life)
         return result
 
     def getCounter(self, name, default=None):
-        return self.getCounters().get(name, default)
+        head, _, half_life = name.rpartition('.')
+        for hl in self.half_lives:
+            if str(hl) == half_life and head.endswith(self.suffix):
+                return self.getvalue(hl)
+        return default
 
     def iterkeys(self):
-        for type in self.types:
+        prefix = ''
+        if self.name is not None:
+            prefix = self.name + '.'
+        for half_life in self.half_lives:
+            yield prefix + self.suffix + '.' + str(half_life)
+
+    def _genCounterSeries(self):
+        """Yields one series, labelled by `half_life`."""
+        for name, half_life in zip(self.iterkeys(), self.half_lives):
+            yield (name.rpartition('.')[0], {'half_life': str(half_life)},
+                   partial(self.getCounter, name))
+
+ewma = EWMA
+
+
+class DecayingRate(EWMA):
+    """Exponentially decaying per-second rate of the values `add`ed
+
+    Like the load average, but for throughput: each half-life's estimate
+    decays towards zero while nothing is added.  Exported as e.g.
+    `requests.ewma_rate.60`.
+    """
+    __slots__ = ()
+    suffix = 'ewma_rate'
+
+    def add(self, value):
+        now = self._now()
+        with self._lock:
+            self._decayTo(now)
+            for i in range(len(self._sums)):
+                self._sums[i] += value
+
+    def increment(self):
+        self.add(1.0)
+
+    def incrementBy(self, value):
+        self.add(value)
+
+    def getvalue(self, half_life):
+        i = self.half_lives.index(half_life)
+        now = self._now()
+        with self._lock:
+            total = self._sums[i]
+            last = self._last
+        if last is not None:
+            total *= self._decay(max(0.0, now - last), half_life)
+        # The decayed total of a steady rate, r, converges to
+        # r * half_life / ln(2)
+        return total * math.log(2) / half_life
+
+decaying_rate = DecayingRate
+
+
+class KeyedCounter(_Nameable, _Bindable, ProvidesDynamicCounters):
+    """A family of counters, created lazily for each key they're updated with
+
+    For example, `requests_by_method = keyed_counter(max_keys=500)` exports
+    `requests_by_method.<method>` for each method passed to `add`.  Once
+    there are more than `max_keys` keys, the least recently updated ones are
+    evicted, so memory stays bounded for high-cardinality keys.
+    """
+    __slots__ = ('name', '_bound', 'max_keys', 'counter_class', 'n_evicted',
+                 '_children', '_lock')
+
+    def __init__(self, max_keys=1000, counter_class=Sum, name=None):
+        super(KeyedCounter, self).__init__(name)
+        self.max_keys = max_keys
+        self.counter_class = counter_class
+        self.n_evicted = 0
+        self._children = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _bind(self, obj):
+        return self.__class__(max_keys=self.max_keys,
+                              counter_class=self.counter_class,
+                              name=self.name)
+
+    def get(self, key):
+        """Return the counter for `key`, creating it if necessary.
+
+        Marks `key` as the most recently updated."""
+        key = str(key)
+        with self._lock:
+            child = self._children.pop(key, None)
+            if child is None:
+                child = self.counter_class(name=key)
+                while len(self._children) >= self.max_keys:
+                    self._children.popitem(last=False)
+                    self.n_evicted += 1
+            self._children[key] = child
+        return child
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def add(self, key, value):
+        self.get(key).add(value)
+
+    def increment(self, key):
+        self.add(key, 1.0)
+
+    def incrementBy(self, key, value):
+        self.add(key, value)
+
+    def keys(self):
+        with self._lock:
+            return list(self._children)
+
+    def _counterName(self, key):
+        if self.name is None:
+            return key
+        return self.name + '.' + key
+
+    def _genCounterCallbacks(self):
+        with self._lock:
+            children = list(iteritems(self._children))
+        for key, child in children:
+            yield self._counterName(key), child
+
+    def _genCounterSeries(self):
+        """Yields one series, labelled by `key`."""
+        with self._lock:
+            children = list(iteritems(self._children))
+        for key, child in children:
+            yield self.name, {'key': key}, child
+
+    def _getCounterCallback(self, name):
+        if self.name is not None:
+            if not name.startswith(self.name + '.'):
+                return None
+            name = name[len(self.name) + 1:]
+        # Unknown (or evicted) keys are still ours, they just have no value
+        return self._children.get(name, lambda: None)
+
+keyed_counter = KeyedCounter
+
+
+class TopK(_Nameable, _Bindable, ProvidesDynamicCounters):
+    """Approximate the `k` most frequent keys, in fixed memory
+
+    Implements the space-saving algorithm with `capacity` monitored keys.
+    When an unmonitored key arrives and all slots are taken, it replaces the
+    key with the smallest count, inheriting that count as its error.  Any key
+    occurring more than total / `capacity` times is guaranteed to be tracked,
+    and counts overestimate by at most total / `capacity`.
+
+    Updating a monitored key is O(1).  The smallest count is found with a
+    min-heap holding one (count, seq, key) entry per monitored key, whose
+    count may lag the key's real one.  Stale entries are only refreshed when
+    they reach the top, so displacing a key is amortized O(log capacity).
+
+    The current top `k` keys are exported as `<name>.<key>` with their
+    estimated counts.  See also `json()` for use with `setExportedValue`.
+    """
+    __slots__ = ('name', '_bound', 'k', 'capacity', 'total', '_counts',
+                 '_heap', '_seq', '_lock')
+
+    def __init__(self, k=10, capacity=None, name=None):
+        super(TopK, self).__init__(name)
+        self.k = k
+        self.capacity = capacity or k * 10
+        assert self.capacity >= k
+        self.total = 0
+        # key -> [count, error]
+        self._counts = {}
+        # (count when pushed, tiebreak, key) for each key in `_counts`
+        self._heap = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _bind(self, obj):
+        return self.__class__(k=self.k, capacity=self.capacity,
+                              name=self.name)
+
+    def add(self, key, value=1):
+        with self._lock:
+            self.total += value
+            entry = self._counts.get(key)
+            if entry is not None:
+                entry[0] += value
+            elif len(self._counts) < self.capacity:
+                self._counts[key] = [value, 0]
+                self._push(key, value)
+            else:
+                floor = self._popMin()
+                self._counts[key] = [floor + value, floor]
+                self._push(key, floor + value)
+
+    def _push(self, key, count):
+        """Add a heap entry for `key`.  Requires `_lock`"""
+        self._seq += 1
+        heappush(self._heap, (count, self._seq, key))
+
+    def _popMin(self):
+        """Evict the key with the smallest count, and return its count.
+
+        Counts only grow, so an entry's count is a lower bound of its key's.
+        Once the top entry is current, its key has the smallest count.
+        Requires `_lock`.
+        """
+        heap = self._heap
+        while True:
+            count, _, key = heap[0]
+            current = self._counts[key][0]
+            if current == count:
+                heappop(heap)
+                return self._counts.pop(key)[0]
+            self._seq += 1
+            heapreplace(heap, (current, self._seq, key))
+
+    def increment(self, key):
+        self.add(key)
+
+    def top(self):
+        """Return [(key, estimated count, max overestimate)], largest first"""
+        with self._lock:
+            items = [(key, count, error)
+                     for key, (count, error) in iteritems(self._counts)]
+        items.sort(key=lambda item: item[1], reverse=True)
+        return items[:self.k]
+
+    def json(self):
+        """Return the `top()` keys as a JSON list of objects"""
+        return json.dumps([{'key': str(key), 'count': count, 'error': error}
+                           for key, count, error in self.top()])
+
+    def reset(self):
+        with self._lock:
+            self.total = 0
+            self._counts = {}
+            self._heap = []
+
+    def _counterName(self, key):
+        if self.name is None:
+            return str(key)
+        return self.name + '.' + str(key)
+
+    def _genCounterCallbacks(self):
+        for key, count, error in self.top():
+            yield self._counterName(key), partial(self._getCount, key)
+
+    def _genCounterSeries(self):
+        """Yields one series, labelled by `key`."""
+        for key, count, error in self.top():
+            yield self.name, {'key': str(key)}, partial(self._getCount, key)
+
+    def _getCount(self, key):
+        entry = self._counts.get(key)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def _getCounterCallback(self, name):
+        if self.name is not None:
+            if not name.startswith(self.name + '.'):
+                return None
+        for key, count, error in self.top():
+            if self._counterName(key) == name:
+                return partial(self._getCount, key)
+        return lambda: None
+
+top_k = TopK
+
+
+def _hash64(key):
+    """Return a well-mixed 64-bit hash of `key` (stable within a process)"""
+    # splitmix64 finalizer, since `hash()` of small ints is the identity
+    x = hash(key) & 0xffffffffffffffff
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+    return x ^ (x >> 31)
+
+
+class _HyperLogLog(object):
+    """HyperLogLog registers for estimating the number of distinct hashes"""
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, index, rank):
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, hll):
+        registers = self.registers
+        for i, rank in enumerate(hll.registers):
+            if rank > registers[i]:
+                registers[i] = rank
+
+    def estimate(self):
+        m = len(self.registers)
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+
+        estimate = alpha * m * m / sum(2.0 ** -rank
+                                       for rank in self.registers)
+        if estimate <= 2.5 * m:
+            # Small range correction: fall back to linear counting
+            zeros = self.registers.count(b'\0')
+            if zeros:
+                estimate = m * math.log(m / float(zeros))
+        return estimate
+
+
+class Distinct(_Nameable, _Bindable, ProvidesCounters):
+    """Approximate count of the distinct keys `add`ed over each window
+
+    Backed by HyperLogLog registers (2 ** `precision` bytes each, with a
+    standard error of 1.04 / sqrt(2 ** `precision`)).  Each window is split
+    into `slices` sub-windows whose registers are merged when read, so
+    windows expire with a granularity of window / `slices` and use
+    (`slices` + 1) * 2 ** `precision` bytes, regardless of cardinality.
+
+    Exported as e.g. `unique_clients.distinct.60`.  A `None` window counts
+    distinct keys for all time (`unique_clients.distinct`).
+    """
+    __slots__ = ('name', '_bound', 'windows', 'all_time', 'precision',
+                 'slices', '_slices', '_all_time', '_lock', '_now')
+    suffix = 'distinct'
+
+    def __init__(self, windows=None, name=None, precision=10, slices=6):
+        super(Distinct, self).__init__(name)
+        assert 4 <= precision <= 16
+        windows = windows or [60, 3600]
+        self.windows = sorted(w for w in windows if w is not None)
+        self.all_time = None in windows
+        self.precision = precision
+        self.slices = slices
+        # window -> deque([(slice start, _HyperLogLog)])
+        self._slices = dict((window, deque()) for window in self.windows)
+        self._all_time = _HyperLogLog(precision) if self.all_time else None
+        self._lock = threading.Lock()
+        # Defined to allow unittest overriding
+        self._now = time.time
+
+    def _bind(self, obj):
+        windows = self.windows
+        if self.all_time:
+            windows = windows + [None]
+        return self.__class__(windows=windows, name=self.name,
+                              precision=self.precision, slices=self.slices)
+
+    def _expire(self, window, now):
+        slices = self._slices[window]
+        width = window / float(self.slices)
+        while slices and slices[0][0] + width <= now - window:
+            slices.popleft()
+
+    def add(self, key):
+        x = _hash64(key)
+        bits = 64 - self.precision
+        index = x >> bits
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+
+        now = self._now()
+        with self._lock:
             for window in self.windows:
-                yield self.name + '.' + type + '.' + str(window)
-        # TODO: Infinite Windows
+                width = window / float(self.slices)
+                start = now - now % width
+                slices = self._slices[window]
+                if not slices or slices[-1][0] != start:
+                    self._expire(window, now)
+                    slices.append((start, _HyperLogLog(self.precision)))
+                slices[-1][1].add(index, rank)
+
+            if self._all_time is not None:
+                self._all_time.add(index, rank)
+
+    def getvalue(self, window):
+        """Return the estimated distinct count for `window` (or None)"""
+        if window is None:
+            return int(round(self._all_time.estimate()))
+
+        merged = _HyperLogLog(self.precision)
+        with self._lock:
+            self._expire(window, self._now())
+            for start, hll in self._slices[window]:
+                merged.merge(hll)
+        return int(round(merged.estimate()))
+
+    def _counterName(self, window):
+        name = self.suffix
+        if window is not None:
+            name += '.' + str(window)
+        if self.name is not None:
+            name = self.name + '.' + name
+        return name
+
+    def _genCounterCallbacks(self):
+        """Yield all the child counters."""
+        for subcounter in self.iterkeys():
+            yield subcounter, partial(self.getCounter, subcounter)
+
+    def getCounters(self):
+        result = {}
+        for window in self._iterwindows():
+            result[self._counterName(window)] = self.getvalue(window)
+        return result
+
+    def getCounter(self, name, default=None):
+        for window in self._iterwindows():
+            if self._counterName(window) == name:
+                return self.getvalue(window)
+        return default
+
+    def _iterwindows(self):
+        for window in self.windows:
+            yield window
+        if self.all_time:
+            yield None
+
+    def iterkeys(self):
+        for window in self._iterwindows():
+            yield self._counterName(window)
 
+    def _genCounterSeries(self):
+        """Yields one series, labelled by `window`."""
+        for window in self._iterwindows():
+            labels = {'window': 'all' if window is None else str(window)}
+            yield (self._counterName(None), labels,
+                   partial(self.getCounter, self._counterName(window)))
 
-samples = Samples
+distinct = Distinct
@@ -16,3 +16,4 @@ def HAS(module):
 HAS_PSUTIL = HAS('psutil')
 HAS_THRIFT = HAS('thrift')
 HAS_DAEMONIZE = HAS('daemonize')
+HAS_NUMPY = HAS('numpy')
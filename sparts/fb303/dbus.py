@@ -68,6 +68,16 @@ class FB303DbusService(dbus.service.Object):
     def getCounter(self, key):
         return self.handler.getCounter(key)
 
+    @dbus.service.method(dbus_interface='com.facebook.fb303.Service',
+                         in_signature='as', out_signature='a{sx}')
+    def getSelectedCounters(self, keys):
+        return self.handler.getSelectedCounters(keys)
+
+    @dbus.service.method(dbus_interface='com.facebook.fb303.Service',
+                         in_signature='s', out_signature='a{sx}')
+    def getRegexCounters(self, regex):
+        return self.handler.getRegexCounters(regex)
+
     @dbus.service.method(dbus_interface='com.facebook.fb303.Service',
                          in_signature='ss', out_signature='')
     def setOption(self, key, value):
@@ -0,0 +1,68 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+"""Helpers for rendering counters in the Prometheus text exposition format
+
+See sparts.tasks.tornado_prometheus for an HTTP endpoint that serves them.
+"""
+from __future__ import absolute_import
+
+import math
+import re
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_INVALID_NAME_CHARS = re.compile(r'[^a-zA-Z0-9_:]')
+
+
+def metric_name(name):
+    """Returns `name` with characters Prometheus doesn't allow replaced"""
+    name = _INVALID_NAME_CHARS.sub('_', name)
+    if name[:1].isdigit():
+        name = '_' + name
+    return name
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (metric_name(k), str(v).replace('\\', '\\\\')
+                     .replace('\n', '\\n').replace('"', '\\"'))
+        for k, v in sorted(labels.items()))
+
+
+def _format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def render(obj, prefix=''):
+    """Returns the counters of `obj` (e.g., a service) in the text format
+
+    Counters with several dimensions, like `samples()` windows and
+    `keyed_counter()` keys, are rendered as labelled series of one metric
+    (see `_SpartsObject.getCounterSeries()`).  Counters whose value is None
+    are omitted."""
+    families = {}
+    for name, labels, callback in obj.getCounterSeries():
+        value = callback()
+        if value is None:
+            continue
+        families.setdefault(metric_name(prefix + name), []).append(
+            (_format_labels(labels), _format_value(value)))
+
+    lines = []
+    for name in sorted(families):
+        lines.append('# TYPE %s untyped' % name)
+        for labels, value in sorted(families[name]):
+            lines.append('%s%s %s' % (name, labels, value))
+    lines.append('')
+    return '\n'.join(lines)
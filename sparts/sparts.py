@@ -7,13 +7,20 @@
 """Module for common base classes and helpers, such as options and counters"""
 from __future__ import absolute_import
 
+from bisect import bisect_left
 from collections import namedtuple
 from functools import partial
 from six import iteritems
+from sparts.compat import OrderedDict
+
+import re
+import threading
 
 
 class _Nameable(object):
     """Base class for attribute classes with automatically set `name` attribute"""
+    __slots__ = ()
+
     def __init__(self, name):
         super(_Nameable, self).__init__()
         self.name = name
@@ -24,6 +31,8 @@ class _Nameable(object):
 
 class _Bindable(object):
     """Helper class for allowing instance-unique class-declarative behavior."""
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         self._bound = {}
         super(_Bindable, self).__init__(*args, **kwargs)
@@ -41,10 +50,92 @@ class _Bindable(object):
         raise NotImplementedError()
 
 class ProvidesCounters(object):
+    __slots__ = ()
+
     def _genCounterCallbacks(self):
         """Yields this item's (names, value) counter tuple(s)."""
         raise NotImplementedError()
 
+    def _genCounterSeries(self):
+        """Yields this item's (name, labels, value) counter tuple(s).
+
+        `labels` is a dict of dimensions (like a window, or a key) that
+        distinguish counters sharing the metric `name`.  By default, each
+        counter is its own, unlabeled, metric."""
+        for k, v in self._genCounterCallbacks():
+            yield k, {}, v
+
+
+class ProvidesDynamicCounters(ProvidesCounters):
+    """Base class for counter-like things whose counters change at runtime.
+
+    Instead of being statically assigned when an object is created, these
+    counters are enumerated with `_genCounterCallbacks()` every time
+    counters are requested."""
+    __slots__ = ()
+
+    def _getCounterCallback(self, name):
+        """Returns the callable for counter `name`, or None."""
+        raise NotImplementedError()
+
+_REGEX_SPECIAL = frozenset('.^$*+?{}[]|()\\')
+_REGEX_OPTIONAL = ('*', '?', '{')
+
+def _regex_prefix(pattern):
+    """Returns the literal prefix of every string `pattern` can `re.match()`
+
+    This is conservative; it stops at the first character that isn't a
+    plain literal (or an escaped punctuation literal, like `\\.`)."""
+    if '|' in pattern:
+        return ''
+
+    prefix = []
+    i = 0
+    if pattern.startswith('^'):
+        i = 1
+    while i < len(pattern):
+        c = pattern[i]
+        step = 1
+        if c == '\\':
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                break
+            c = pattern[i + 1]
+            step = 2
+        elif c in _REGEX_SPECIAL:
+            break
+
+        # A literal followed by `*`, `?`, or `{m,n}` may not be present
+        if pattern[i + step:i + step + 1] in _REGEX_OPTIONAL:
+            break
+        prefix.append(c)
+        i += step
+    return ''.join(prefix)
+
+
+def _iter_prefix(keys, prefix):
+    """Yields the items of the sorted list, `keys`, that start with `prefix`"""
+    for i in range(bisect_left(keys, prefix), len(keys)):
+        if not keys[i].startswith(prefix):
+            break
+        yield keys[i]
+
+
+_REGEX_CACHE_SIZE = 64
+_regex_cache = OrderedDict()
+_regex_cache_lock = threading.Lock()
+
+def _compile_regex(pattern):
+    """Returns (compiled `pattern`, its literal prefix), cached in an LRU"""
+    with _regex_cache_lock:
+        entry = _regex_cache.pop(pattern, None)
+        if entry is None:
+            entry = (re.compile(pattern), _regex_prefix(pattern))
+            if len(_regex_cache) >= _REGEX_CACHE_SIZE:
+                _regex_cache.popitem(last=False)
+        _regex_cache[pattern] = entry
+        return entry
+
+
 _AddArgArgs = namedtuple('_AddArgArgs', ['opts', 'kwargs'])
 
 class option(_Nameable):
@@ -143,6 +234,46 @@ class option(_Nameable):
         return name
 
 
+class _CounterDict(dict):
+    """The `counters` of a `_SpartsObject`.
+
+    `version` is bumped by every change, so that indexes of counter names
+    (see `getCounterNames()`) can cheaply tell when they are stale."""
+    __slots__ = ('version', )
+
+    def __init__(self, *args, **kwargs):
+        super(_CounterDict, self).__init__(*args, **kwargs)
+        self.version = 0
+
+    def __setitem__(self, key, value):
+        super(_CounterDict, self).__setitem__(key, value)
+        self.version += 1
+
+    def __delitem__(self, key):
+        super(_CounterDict, self).__delitem__(key)
+        self.version += 1
+
+    def clear(self):
+        super(_CounterDict, self).clear()
+        self.version += 1
+
+    def pop(self, *args):
+        self.version += 1
+        return super(_CounterDict, self).pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super(_CounterDict, self).popitem()
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return super(_CounterDict, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super(_CounterDict, self).update(*args, **kwargs)
+        self.version += 1
+
+
 class _NameHelper(type):
     def __new__(cls, name, bases, attrs):
 
@@ -155,26 +286,39 @@ class _NameHelper(type):
             v.name = v._getNameForIdentifier(k)
         return super(_NameHelper, cls).__new__(cls, name, bases, attrs)
 
+    def __init__(cls, name, bases, attrs):
+        super(_NameHelper, cls).__init__(name, bases, attrs)
+
+        # Traverse all child objects once per class, and statically collect
+        # callable references to all child counters.  Counters are bound
+        # per-class, so these are shared by every instance of `cls`.
+        cls._counter_callbacks = []
+        cls._counter_providers = []
+        cls._dynamic_counters = []
+        for k in dir(cls):
+            v = getattr(cls, k)
+            if isinstance(v, ProvidesDynamicCounters):
+                cls._dynamic_counters.append(v)
+            elif isinstance(v, ProvidesCounters):
+                cls._counter_providers.append(v)
+                cls._counter_callbacks.extend(v._genCounterCallbacks())
+
 
 _SpartsObjectBase = _NameHelper('_SpartsObjectBase', (object, ), {})
 
 class _SpartsObject(_SpartsObjectBase):
     def __new__(cls, *args, **kwargs):
         inst = super(_SpartsObject, cls).__new__(cls)
-        inst.counters = {}
-        #for k, v in iteritems(cls.__dict__):
 
-        # Traverse all child objects and statically assign a callable
-        # reference to all child counters to the instance's counters dictionary.
+        # Assign the class's precomputed (see `_NameHelper`) child counter
+        # callables to the instance's counters dictionary.
         #
         # This is sort of implicitly broken for Callback counters, which are
         # defined after __new__ is called (e.g., during Task initialization)
         # TODO: Implement this in a better way.
-        for k in dir(cls):
-            v = getattr(cls, k)
-            if isinstance(v, ProvidesCounters):
-                for cn, cv in v._genCounterCallbacks():
-                    inst.counters[cn] = cv
+        inst.counters = _CounterDict(cls._counter_callbacks)
+        inst.dynamic_counters = list(cls._dynamic_counters)
+        inst._counter_index = None
 
         return inst
 
@@ -183,26 +327,144 @@ class _SpartsObject(_SpartsObjectBase):
         raise NotImplementedError()
 
     def getCounters(self):
-        result = {}
-        for k in self.counters:
-            result[k] = self.getCounter(k)
+        return self._getAllCounters()
+
+    def _getAllCounters(self):
+        """Implements `getCounters()`, including the counters of children.
+
+        Children are walked with this, rather than `getCounters()`, which
+        handler tasks like `FB303HandlerTask` override with an RPC."""
+        result = dict(self.counters)
+
+        for provider in self.dynamic_counters:
+            for k, v in provider._genCounterCallbacks():
+                result[k] = v
 
         for cn, c in iteritems(self.getChildren()):
-            for k in c.counters:
-                result[cn + '.' + k] = c.getCounter(k)
+            for k, v in iteritems(c._getAllCounters()):
+                result[cn + '.' + k] = v
 
         return result
 
+    def _getStaticCounters(self):
+        """Like `_getAllCounters()`, but without any `dynamic_counters`
+
+        For consumers that assign each name a fixed slot, which dynamic
+        counters' (possibly unbounded) names would exhaust."""
+        result = dict(self.counters)
+        for cn, c in iteritems(self.getChildren()):
+            for k, v in iteritems(c._getStaticCounters()):
+                result[cn + '.' + k] = v
+        return result
+
     def getCounter(self, name):
+        return self._getCounter(name)
+
+    def _getCounter(self, name):
+        """Implements `getCounter()`, safe to call on children that override
+        it (see `_getAllCounters()`)"""
+        if name not in self.counters:
+            for provider in self.dynamic_counters:
+                callback = provider._getCounterCallback(name)
+                if callback is not None:
+                    return callback
+
         # Hack to get counters from a child task, even if the callable
         # wasn't statically assigned to this instance's counters dictionary.
         # TODO: Figure out a better way to do this.
         if name not in self.counters and '.' in name:
             child, sep, name = name.partition('.')
-            return self.getChild(child).getCounter(name)
+            return self.getChild(child)._getCounter(name)
 
         return self.counters.get(name, lambda: None)
 
+    def _getCounterIndexKey(self):
+        """Returns a cheap fingerprint of the set of static counter names"""
+        return (id(self.counters), self.counters.version,
+                tuple(sorted((cn, c._getCounterIndexKey())
+                             for cn, c in iteritems(self.getChildren()))))
+
+    def getCounterNames(self):
+        """Returns a sorted list of this object's static counter names.
+
+        Includes the counters of children, but not `dynamic_counters`, whose
+        names change at runtime.  The list is rebuilt only when counters are
+        added or removed."""
+        key = self._getCounterIndexKey()
+        index = self._counter_index
+        if index is None or index[0] != key:
+            names = list(self.counters)
+            for cn, c in iteritems(self.getChildren()):
+                names.extend(cn + '.' + k for k in c.getCounterNames())
+            index = self._counter_index = (key, sorted(names))
+        return index[1]
+
+    def _genDynamicCounterCallbacks(self):
+        for provider in self.dynamic_counters:
+            for k, v in provider._genCounterCallbacks():
+                yield k, v
+
+        for cn, c in iteritems(self.getChildren()):
+            for k, v in c._genDynamicCounterCallbacks():
+                yield cn + '.' + k, v
+
+    def getPrefixCounters(self, prefix):
+        """Returns counters whose names start with `prefix`"""
+        result = {}
+        for k in _iter_prefix(self.getCounterNames(), prefix):
+            result[k] = self.getCounter(k)
+
+        for k, v in self._genDynamicCounterCallbacks():
+            if k.startswith(prefix):
+                result[k] = v
+        return result
+
+    def getRegexCounters(self, regex):
+        """Returns counters whose names `re.match()` the pattern, `regex`
+
+        Only names sharing `regex`'s literal prefix are tested, so anchored
+        patterns like `QueueTask\\.n_.*` avoid scanning every counter."""
+        matcher, prefix = _compile_regex(regex)
+        result = {}
+        for k in _iter_prefix(self.getCounterNames(), prefix):
+            if matcher.match(k) is not None:
+                result[k] = self.getCounter(k)
+
+        for k, v in self._genDynamicCounterCallbacks():
+            if matcher.match(k) is not None:
+                result[k] = v
+        return result
+
+    def getSelectedCounters(self, keys):
+        """Returns counters for the names in `keys`"""
+        return dict((k, self.getCounter(k)) for k in keys)
+
+    def getCounterSeries(self):
+        """Returns a list of (name, labels, callable) for every counter.
+
+        Unlike `getCounters()`, this preserves the structure of counters
+        with several dimensions, like `samples()` windows or `keyed_counter()`
+        keys, as `labels` (see `ProvidesCounters._genCounterSeries()`)."""
+        result = []
+        static_names = set()
+        for provider in self._counter_providers:
+            for k, labels, v in provider._genCounterSeries():
+                result.append((k, labels, v))
+            static_names.update(k for k, v in provider._genCounterCallbacks())
+
+        # Counters assigned directly to `self.counters` (e.g., callbacks)
+        for k in self.counters:
+            if k not in static_names:
+                result.append((k, {}, self.counters[k]))
+
+        for provider in self.dynamic_counters:
+            result.extend(provider._genCounterSeries())
+
+        for cn, c in iteritems(self.getChildren()):
+            for k, labels, v in c.getCounterSeries():
+                result.append((cn + '.' + k, labels, v))
+        return result
+
     def getChild(self, name):
         return self.getChildren()[name]
 
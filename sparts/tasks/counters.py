@@ -0,0 +1,756 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+"""Tasks related to collecting and publishing a service's counters"""
+from __future__ import absolute_import
+
+from six import iteritems
+from sparts.collections import ChangeLog, ChangeSet
+from sparts.counters import _BaseCounter, CallbackCounter, Count, counter, \
+    Max, Min, samples, SampleType, Sum
+from contextlib import contextmanager
+from sparts.fileutils import makedirs
+from sparts.sparts import option, ProvidesDynamicCounters
+from sparts.tasks.periodic import PeriodicTask
+from sparts.vtask import SkipTask
+
+import fcntl
+import math
+import mmap
+import os
+import re
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+
+class CounterSnapshotTask(PeriodicTask):
+    """Periodically evaluates all of the service's counters into a snapshot
+
+    Evaluating every counter callable on each monitoring request is
+    O(all counters).  With this task registered, `FB303HandlerTask` (and
+    anything else using `getSnapshot()`) reads the most recent snapshot
+    instead.
+
+    Each snapshot is built off to the side and then published by swapping a
+    single reference, so readers never observe a partially built snapshot.
+    The snapshot's age is exported as `snapshot_age_ms`.  It is left out of
+    the snapshot itself, since only its live value says how stale the
+    snapshot being served is.
+
+    Scrapers can poll `getSnapshotSince()` with a cursor to receive only the
+    counters whose values changed in the snapshots taken since then.
+    """
+    INTERVAL = 1.0
+    OPT_PREFIX = 'counter_snapshot'
+
+    def initTask(self):
+        super(CounterSnapshotTask, self).initTask()
+        self.snapshot = None
+        self.snapshot_time = None
+        self._int_counters = (None, None)
+        self.changelog = ChangeLog()
+        self.counters['snapshot_age_ms'] = \
+            CallbackCounter(self.getSnapshotAgeMs)
+        # The service-wide name of the above
+        self.age_counter_name = self.name + '.snapshot_age_ms'
+
+    def execute(self, context=None):
+        snapshot = {}
+        for k, v in iteritems(self.service.getCounters()):
+            if k == self.age_counter_name:
+                continue
+            v = v()
+            if v is None:
+                continue
+            snapshot[k] = v
+
+        previous = self.snapshot or {}
+        changed = [k for k, v in iteritems(snapshot)
+                   if k not in previous or previous[k] != v]
+        removed = [k for k in previous if k not in snapshot]
+
+        # Publish before recording the changes, so that a reader that sees
+        # the new version always sees (at least) this snapshot's values.
+        self.snapshot, self.snapshot_time = snapshot, time.time()
+        self.changelog.record(changed, removed)
+
+    def getSnapshotAgeMs(self):
+        """Returns the current snapshot's age in ms, or None"""
+        if self.snapshot_time is None:
+            return None
+        return (time.time() - self.snapshot_time) * 1000.0
+
+    def getSnapshot(self):
+        """Returns the most recent snapshot, a dict of counter values.
+
+        Returns None if no snapshot has been taken yet."""
+        return self.snapshot
+
+    def getIntSnapshot(self):
+        """Like `getSnapshot()`, but with values cast to `int` for fb303.
+
+        The cast dict is cached for the lifetime of each snapshot."""
+        snapshot = self.snapshot
+        cached_snapshot, result = self._int_counters
+        if cached_snapshot is not snapshot:
+            result = None
+            if snapshot is not None:
+                result = dict((k, int(v)) for k, v in iteritems(snapshot))
+            self._int_counters = (snapshot, result)
+        return result
+
+    def getSnapshotValue(self, name, default=None):
+        """Returns counter `name`'s value from the most recent snapshot"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            return default
+        return snapshot.get(name, default)
+
+    def getSnapshotSince(self, cursor):
+        """Returns a `ChangeSet` of counters changed since `cursor`
+
+        Pass 0 as the initial cursor, and the returned `cursor` thereafter.
+        Removed counters are included with a value of None."""
+        keys, version = self.changelog.changedSince(cursor)
+        snapshot = self.snapshot or {}
+        if keys is None:
+            return ChangeSet(dict(snapshot), version, True)
+        return ChangeSet(dict((k, snapshot.get(k)) for k in keys),
+                         version, False)
+
+
+class MetricsExporterTask(PeriodicTask):
+    """Periodically pushes the service's counters to a statsd-style collector
+
+    Counters are sent as gauges (`name:value|g`), newline separated and
+    packed into as few datagrams of at most `MAX_DATAGRAM` bytes as
+    possible, over UDP (--metrics-host/--metrics-port) or a unix datagram
+    socket (--metrics-sock).
+
+    Only counters whose values changed since they were last sent are pushed,
+    except every `RESEND_INTERVAL` seconds, when everything is resent so that
+    restarted collectors catch up.  Datagrams that can't be sent (e.g.,
+    because the collector's socket buffer is full) are counted in
+    `n_dropped_metrics`, and their counters are retried next time.
+    """
+    INTERVAL = 10.0
+    OPT_PREFIX = 'metrics'
+    DEFAULT_HOST = '127.0.0.1'
+    DEFAULT_PORT = 8125
+    DEFAULT_SOCK = ''
+    DEFAULT_PREFIX = ''
+    RESEND_INTERVAL = 300.0
+
+    # Fits in a single ethernet frame, including IP/UDP headers
+    MAX_DATAGRAM = 1432
+
+    host = option(metavar='HOST', default=lambda cls: cls.DEFAULT_HOST,
+                  help='Collector address to send metrics to [%(default)s]')
+    port = option(metavar='PORT', type=int,
+                  default=lambda cls: cls.DEFAULT_PORT,
+                  help='Collector port to send metrics to [%(default)s]')
+    sock = option(metavar='PATH', default=lambda cls: cls.DEFAULT_SOCK,
+                  help='Unix datagram socket to send metrics to, instead '
+                       'of host/port [%(default)s]')
+    prefix = option(metavar='PREFIX', default=lambda cls: cls.DEFAULT_PREFIX,
+                    help='Prefix to add to metric names [%(default)s]')
+
+    n_sent_datagrams = counter()
+    n_sent_metrics = counter()
+    n_dropped_metrics = counter()
+    send_duration_ms = samples(windows=[60, 600],
+        types=[SampleType.AVG, SampleType.MAX, SampleType.P99])
+
+    _UNSAFE = re.compile(r'[:|@\s]')
+
+    def initTask(self):
+        super(MetricsExporterTask, self).initTask()
+        if self.sock:
+            self.address = self.sock
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        else:
+            family, socktype, proto, canonname, self.address = \
+                socket.getaddrinfo(self.host, self.port, 0,
+                                   socket.SOCK_DGRAM)[0]
+            self.socket = socket.socket(family, socktype, proto)
+
+        # Never block the task on a slow collector; drop instead
+        self.socket.setblocking(False)
+        self.last_sent = {}
+        self.last_resend = time.time()
+
+    def stop(self):
+        super(MetricsExporterTask, self).stop()
+        self.socket.close()
+
+    def formatMetric(self, name, value):
+        """Returns the statsd line for counter `name`, or None to skip it"""
+        if math.isnan(value) or math.isinf(value):
+            return None
+        if value == int(value):
+            value = int(value)
+        else:
+            value = repr(float(value))
+        return '%s%s:%s|g' % (self.prefix, self._UNSAFE.sub('_', name),
+                              value)
+
+    def execute(self, context=None):
+        now = time.time()
+        if now - self.last_resend >= self.RESEND_INTERVAL:
+            self.last_sent = {}
+            self.last_resend = now
+
+        changed = []
+        for k, v in iteritems(self.service.getCounters()):
+            v = v()
+            if v is None or self.last_sent.get(k) == v:
+                continue
+            line = self.formatMetric(k, v)
+            if line is not None:
+                changed.append((k, v, line))
+
+        with self.send_duration_ms.time():
+            for batch, datagram in self._genDatagrams(changed):
+                try:
+                    self.socket.sendto(datagram, self.address)
+                except socket.error as e:
+                    self.logger.debug('Unable to send metrics: %s', e)
+                    self.n_dropped_metrics.incrementBy(len(batch))
+                    continue
+
+                self.n_sent_datagrams.increment()
+                self.n_sent_metrics.incrementBy(len(batch))
+                for k, v, line in batch:
+                    self.last_sent[k] = v
+
+    def _genDatagrams(self, metrics):
+        """Yields (metrics, datagram bytes), packing `metrics` greedily"""
+        batch, size = [], 0
+        for metric in metrics:
+            length = len(metric[2].encode('utf-8')) + 1
+            if batch and size + length > self.MAX_DATAGRAM:
+                yield batch, self._encode(batch)
+                batch, size = [], 0
+            batch.append(metric)
+            size += length
+
+        if batch:
+            yield batch, self._encode(batch)
+
+    def _encode(self, batch):
+        return '\n'.join(line for k, v, line in batch).encode('utf-8')
+
+
+class _HistoryRing(object):
+    """A fixed-size, memory-mapped ring of fixed-width counter frames
+
+    Each frame is a float64 timestamp followed by `width` float64 values,
+    one column per counter (NaN if it had no value).  The frame for time
+    `ts` is stored in slot `int(ts // resolution) % slots`, so writes are
+    O(1), the file never grows, and frames older than `retention` seconds
+    are overwritten in place.
+    """
+    def __init__(self, path, resolution, slots, width):
+        self.path = path
+        self.resolution = resolution
+        self.slots = slots
+        self.width = width
+        self.retention = resolution * slots
+        self._frame = struct.Struct('<%dd' % (width + 1))
+        self._double = struct.Struct('<d')
+        # Whether the file was (re)created, discarding any previous frames
+        self.reset = False
+
+        size = self._frame.size * slots
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Start over if the file was created with a different geometry
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                self.reset = True
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.mm.close()
+
+    def _offset(self, bucket):
+        return (bucket % self.slots) * self._frame.size
+
+    def write(self, ts, values):
+        """Stores `values` (`width` floats) in the frame for time `ts`"""
+        bucket = int(ts // self.resolution)
+        self._frame.pack_into(self.mm, self._offset(bucket),
+                              bucket * self.resolution, *values)
+
+    def read(self, column, start, end):
+        """Returns [(ts, value), ...] for counter `column` in [start, end]"""
+        result = []
+        first = int(start // self.resolution)
+        last = int(end // self.resolution)
+        for bucket in range(max(first, last - self.slots + 1), last + 1):
+            offset = self._offset(bucket)
+            ts, = self._double.unpack_from(self.mm, offset)
+            if ts != bucket * self.resolution:
+                # Never written, or since overwritten by a newer bucket
+                continue
+            value, = self._double.unpack_from(self.mm,
+                                              offset + 8 * (column + 1))
+            if not math.isnan(value):
+                result.append((ts, value))
+        return result
+
+
+class CounterHistoryTask(PeriodicTask):
+    """Periodically records counter values to local, fixed-size history files
+
+    Every second, all counter values are written to --counter-history-path
+    as one fixed-width frame in a memory-mapped ring file, and folded into
+    running averages that are written to 1m and 1h rollup rings.  Each
+    resolution keeps `slots` frames (see `RESOLUTIONS`), so disk usage is
+    fixed at roughly `(max_counters + 1) * 8` bytes per frame.
+
+    Counters are assigned columns in the order they are first seen, and the
+    assignments are kept in a `names` file alongside the rings (and
+    discarded with them, if --counter-history-max-counters changes).
+    Counters beyond --counter-history-max-counters are not recorded.
+    Neither are `ProvidesDynamicCounters`' counters (e.g., `keyed_counter`
+    keys), whose churning names would use up the columns for good.
+
+    Use `getHistory()` (or `FB303HandlerTask.getCounterHistory()`) to query
+    a counter's values over a time range, or `CountersHTTPTask`'s
+    /counters/history to query them remotely.
+    """
+    INTERVAL = 1.0
+    OPT_PREFIX = 'counter_history'
+    DEFAULT_PATH = ''
+    DEFAULT_MAX_COUNTERS = 1024
+
+    # (resolution in seconds, number of frames retained)
+    RESOLUTIONS = [(1, 600), (60, 1440), (3600, 720)]
+
+    path = option(metavar='PATH', default=lambda cls: cls.DEFAULT_PATH,
+                  help='Directory to store counter history in [%(default)s]')
+    max_counters = option(type=int, metavar='N',
+                          default=lambda cls: cls.DEFAULT_MAX_COUNTERS,
+                          help='Maximum number of counters to record '
+                               '[%(default)s]')
+
+    n_untracked_counters = counter()
+
+    def initTask(self):
+        super(CounterHistoryTask, self).initTask()
+        if not self.path:
+            raise SkipTask("--%s-path was not specified" % self.OPT_PREFIX)
+
+        makedirs(self.path)
+        self._openFiles()
+
+    def _openFiles(self):
+        """Opens (or creates) the rings, and loads the column assignments"""
+        self.rings = [
+            _HistoryRing(os.path.join(self.path, '%ds.ring' % resolution),
+                         resolution, slots, self.max_counters)
+            for resolution, slots in self.RESOLUTIONS]
+
+        # Running (bucket, sums, counts) for each ring's current frame
+        self._pending = [(None, None, None) for ring in self.rings]
+
+        self._names_path = os.path.join(self.path, 'names')
+        self.columns = {}
+        if any(ring.reset for ring in self.rings):
+            # The assignments only describe the frames that were discarded
+            self._names_file = open(self._names_path, 'w')
+            return
+
+        if os.path.exists(self._names_path):
+            with open(self._names_path) as f:
+                for column, name in enumerate(f.read().splitlines()):
+                    if column >= self.max_counters:
+                        break
+                    self.columns[name] = column
+        self._names_file = open(self._names_path, 'a')
+
+    def _closeFiles(self):
+        self._names_file.close()
+        for ring in self.rings:
+            ring.close()
+
+    def stop(self):
+        super(CounterHistoryTask, self).stop()
+        self._closeFiles()
+
+    def _getColumn(self, name):
+        """Returns the column for counter `name`, assigning one if needed"""
+        column = self.columns.get(name)
+        if column is None:
+            column = len(self.columns)
+            if column >= self.max_counters:
+                return None
+            self.columns[name] = column
+            self._names_file.write(name + '\n')
+            self._names_file.flush()
+        return column
+
+    def execute(self, context=None):
+        self.record(time.time())
+
+    def record(self, now):
+        """Records the current counter values as of time `now`"""
+        values = [float('nan')] * self.max_counters
+        for k, v in iteritems(self.service._getStaticCounters()):
+            v = v()
+            if v is None:
+                continue
+            column = self._getColumn(k)
+            if column is None:
+                self.n_untracked_counters.increment()
+                continue
+            values[column] = v
+
+        for i, ring in enumerate(self.rings):
+            bucket, sums, counts = self._pending[i]
+            if bucket != int(now // ring.resolution):
+                bucket = int(now // ring.resolution)
+                sums = [0.0] * self.max_counters
+                counts = [0] * self.max_counters
+                self._pending[i] = (bucket, sums, counts)
+
+            # Rewrite the current frame with the average so far, so the
+            # current minute (or hour) can be queried before it ends.
+            for column, v in enumerate(values):
+                if not math.isnan(v):
+                    sums[column] += v
+                    counts[column] += 1
+            ring.write(now, [s / c if c else float('nan')
+                             for s, c in zip(sums, counts)])
+
+    def getHistory(self, name, start, end):
+        """Returns [(ts, value), ...] for counter `name` from start to end
+
+        Uses the finest resolution that still retains `start`."""
+        column = self.columns.get(name)
+        if column is None:
+            return []
+
+        now = time.time()
+        for ring in self.rings:
+            if now - ring.retention <= start:
+                break
+        return ring.read(column, start, end)
+
+
+class _SharedCounterTable(object):
+    """Counter values for several processes, in one memory-mapped file
+
+    The file holds a header, a table of counter names (so that every process
+    agrees on each counter's column), and one fixed-width slot per worker
+    process: its pid, a heartbeat timestamp, and a float64 per column.
+
+    Each process only writes to the slot it claimed, so slot writes don't
+    need locking.  Claiming slots and assigning columns to new counter
+    names are serialized with `flock()` on the file.  An existing file's
+    geometry takes precedence over `slots` and `width`.
+    """
+    MAGIC = b'SPRTSHC1'
+    NAME_SIZE = 128
+
+    # magic, slots, width, number of assigned names
+    _header = struct.Struct('<8sIII')
+    _slot_header = struct.Struct('<qd')
+
+    def __init__(self, path, slots, width):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._lock():
+            data = os.read(self._fd, self._header.size)
+            if len(data) == self._header.size:
+                magic, slots, width, _ = self._header.unpack(data)
+                if magic != self.MAGIC:
+                    raise ValueError("%s is not a shared counter file" % path)
+            else:
+                os.ftruncate(self._fd, 0)
+                os.write(self._fd, self._header.pack(self.MAGIC, slots,
+                                                     width, 0))
+
+            self.slots = slots
+            self.width = width
+            self._slot = struct.Struct('<qd%dd' % width)
+            self._names_offset = self._header.size
+            self._slots_offset = self._names_offset + self.NAME_SIZE * width
+            size = self._slots_offset + self._slot.size * slots
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self.mm = mmap.mmap(self._fd, size)
+
+        self.columns = {}
+        self._names = []
+        self._names_lock = threading.Lock()
+
+    def close(self):
+        self.mm.close()
+        os.close(self._fd)
+
+    @contextmanager
+    def _lock(self):
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _slotOffset(self, slot):
+        return self._slots_offset + self._slot.size * slot
+
+    def names(self):
+        """Returns the list of counter names, indexed by column"""
+        n_names = self._header.unpack_from(self.mm, 0)[3]
+        with self._names_lock:
+            for column in range(len(self._names), n_names):
+                offset = self._names_offset + self.NAME_SIZE * column
+                name = self.mm[offset:offset + self.NAME_SIZE].rstrip(b'\0')
+                self._names.append(name.decode('utf-8'))
+                self.columns[self._names[-1]] = column
+            return list(self._names)
+
+    def getColumn(self, name):
+        """Returns the column for counter `name`, or None if the table is full
+
+        Assigns the next free column to names no process has seen yet."""
+        column = self.columns.get(name)
+        if column is not None:
+            return column
+
+        encoded = name.encode('utf-8')
+        if len(encoded) > self.NAME_SIZE:
+            return None
+
+        with self._lock():
+            n_names = len(self.names())
+            if name in self.columns:
+                return self.columns[name]
+            if n_names >= self.width:
+                return None
+
+            offset = self._names_offset + self.NAME_SIZE * n_names
+            self.mm[offset:offset + self.NAME_SIZE] = \
+                encoded.ljust(self.NAME_SIZE, b'\0')
+            self._header.pack_into(self.mm, 0, self.MAGIC, self.slots,
+                                   self.width, n_names + 1)
+        self.names()
+        return self.columns[name]
+
+    def claim(self, pid, now, stale_after):
+        """Claims a free (or stale) slot for `pid`, returning it, or None"""
+        with self._lock():
+            for slot in range(self.slots):
+                owner, heartbeat = self._slot_header.unpack_from(
+                    self.mm, self._slotOffset(slot))
+                if owner == 0 or now - heartbeat > stale_after:
+                    self.write(slot, pid, now, [float('nan')] * self.width)
+                    return slot
+        return None
+
+    def release(self, slot):
+        self._slot_header.pack_into(self.mm, self._slotOffset(slot), 0, 0.0)
+
+    def write(self, slot, pid, now, values):
+        self._slot.pack_into(self.mm, self._slotOffset(slot), pid, now,
+                             *values)
+
+    def read(self, now, stale_after):
+        """Yields (slot, pid, values) for each slot with a fresh heartbeat"""
+        for slot in range(self.slots):
+            row = self._slot.unpack_from(self.mm, self._slotOffset(slot))
+            if row[0] != 0 and now - row[1] <= stale_after:
+                yield slot, row[0], row[2:]
+
+
+# How values of counters (by their type suffix) combine across processes
+_SHARED_AGGREGATIONS = {
+    SampleType.COUNT: sum,
+    SampleType.SUM: sum,
+    SampleType.RATE: sum,
+    'ewma_rate': sum,
+    SampleType.MAX: max,
+    SampleType.MIN: min,
+}
+
+
+def _shared_aggregation(name, callback=None):
+    """Returns how to combine counter `name`'s values across processes
+
+    Returns `sum`, `max` or `min`, or None for values that don't combine
+    (like averages, percentiles or callback gauges), which are only reported
+    per worker.  Counter objects are classified by their type, and anything
+    else (like `samples()` values, or names only known to other processes)
+    by the type suffix of its name."""
+    if isinstance(callback, (Sum, Count)):
+        return sum
+    elif isinstance(callback, Max):
+        return max
+    elif isinstance(callback, Min):
+        return min
+    elif isinstance(callback, _BaseCounter):
+        return None
+
+    # e.g., `foo.avg.60`, `foo.count` or `foo.ewma_rate.300`
+    parts = name.rsplit('.', 2)
+    if len(parts) > 1 and parts[-1].isdigit():
+        parts.pop()
+    return _SHARED_AGGREGATIONS.get(parts[-1])
+
+
+class _SharedCounterValues(ProvidesDynamicCounters):
+    """Exports a `SharedCountersTask`'s totals and per-worker values"""
+    __slots__ = ('task', )
+
+    PREFIXES = ('total.', 'worker.')
+
+    def __init__(self, task):
+        self.task = task
+
+    def _genCounterCallbacks(self):
+        totals, workers = self.task.getSharedCounters()
+        for k, v in iteritems(totals):
+            yield 'total.' + k, lambda v=v: v
+        for slot, values in iteritems(workers):
+            for k, v in iteritems(values):
+                yield 'worker.%d.%s' % (slot, k), lambda v=v: v
+
+    def _getCounterCallback(self, name):
+        if not name.startswith(self.PREFIXES):
+            return None
+        values = dict(self._genCounterCallbacks())
+        return values.get(name, lambda: None)
+
+
+class SharedCountersTask(PeriodicTask):
+    """Shares counters between processes of the same service via shared memory
+
+    When several copies of a service run side by side, each periodically
+    publishes its counters to its own slot in a memory-mapped file (by
+    default, in /dev/shm, named after the service).  Every process then
+    exports `worker.<slot>.<counter>` for each worker, so scraping any one
+    process reports on all of them.
+
+    Counters that can be combined are also exported as `total.<counter>`,
+    over all live workers: sums, counts and rates are summed, and maxes and
+    mins take the max and min.  Averages, percentiles and other values that
+    can't be combined (see `_shared_aggregation()`) are only exported per
+    worker.
+
+    Only static counters are shared.  `ProvidesDynamicCounters`' counters
+    (e.g., `keyed_counter` keys) are not, since the table of names never
+    shrinks, and their churning names would fill it up.
+
+    Workers whose heartbeat is older than `STALE_INTERVALS` intervals (e.g.,
+    because they crashed) are ignored, and their slots can be reclaimed.
+    """
+    INTERVAL = 1.0
+    OPT_PREFIX = 'shared_counters'
+    DEFAULT_PATH = ''
+    DEFAULT_SLOTS = 64
+    DEFAULT_MAX_COUNTERS = 1024
+    STALE_INTERVALS = 3
+
+    path = option(metavar='PATH', default=lambda cls: cls.DEFAULT_PATH,
+                  help='Shared counter file.  Defaults to the service name, '
+                       'in /dev/shm [%(default)s]')
+    slots = option(type=int, metavar='N',
+                   default=lambda cls: cls.DEFAULT_SLOTS,
+                   help='Maximum number of worker processes [%(default)s]')
+    max_counters = option(type=int, metavar='N',
+                          default=lambda cls: cls.DEFAULT_MAX_COUNTERS,
+                          help='Maximum number of counters to share '
+                               '[%(default)s]')
+
+    n_untracked_counters = counter()
+
+    def initTask(self):
+        super(SharedCountersTask, self).initTask()
+        path = self.path
+        if not path:
+            shm = '/dev/shm'
+            if not os.path.isdir(shm):
+                shm = tempfile.gettempdir()
+            path = os.path.join(shm, '%s.counters' % self.service.name)
+
+        self.table = _SharedCounterTable(path, self.slots, self.max_counters)
+        self.slot = self.table.claim(os.getpid(), time.time(),
+                                     self.stale_after)
+        if self.slot is None:
+            self.table.close()
+            raise SkipTask("No free slots in %s" % path)
+
+        # name -> how to combine it, for the counters published by this
+        # process.  Names only published by other processes are classified
+        # by their name.
+        self.aggregations = {}
+        self.dynamic_counters.append(_SharedCounterValues(self))
+
+    @property
+    def stale_after(self):
+        return self.interval * self.STALE_INTERVALS
+
+    def join(self):
+        # Give up the slot once publishing has stopped for good
+        super(SharedCountersTask, self).join()
+        self.table.release(self.slot)
+        self.table.close()
+
+    def execute(self, context=None):
+        self.publish(time.time())
+
+    def publish(self, now):
+        """Writes this process's current counter values to its slot"""
+        values = [float('nan')] * self.table.width
+        # Dynamic counters' churning names would fill up the (persistent)
+        # name table.  This also skips re-sharing the shared values.
+        for k, v in iteritems(self.service._getStaticCounters()):
+            if k not in self.aggregations:
+                self.aggregations[k] = _shared_aggregation(k, v)
+            v = v()
+            if v is None:
+                continue
+            column = self.table.getColumn(k)
+            if column is None:
+                self.n_untracked_counters.increment()
+                continue
+            values[column] = v
+
+        self.table.write(self.slot, os.getpid(), now, values)
+
+    def getSharedCounters(self, now=None):
+        """Returns ({name: total}, {slot: {name: value}}) for live workers
+
+        Only counters that can be combined across workers have totals."""
+        if now is None:
+            now = time.time()
+        names = self.table.names()
+        workers = {}
+        for slot, pid, values in self.table.read(now, self.stale_after):
+            workers[slot] = dict((name, v) for name, v in zip(names, values)
+                                 if not math.isnan(v))
+
+        totals = {}
+        for name in names:
+            if name in self.aggregations:
+                aggregate = self.aggregations[name]
+            else:
+                aggregate = _shared_aggregation(name)
+            if aggregate is None:
+                continue
+            values = [worker[name] for worker in workers.values()
+                      if name in worker]
+            if values:
+                totals[name] = aggregate(values)
+        return totals, workers
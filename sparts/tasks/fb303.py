@@ -7,6 +7,8 @@
 """Module related to implementing fb303 thrift handlers"""
 from __future__ import absolute_import
 
+from sparts.collections import ChangeSet
+from sparts.tasks.counters import CounterHistoryTask, CounterSnapshotTask
 from sparts.tasks.thrift import ThriftHandlerTask
 from sparts.gen.fb303 import FacebookService
 from sparts.gen.fb303.ttypes import fb_status
@@ -61,17 +63,84 @@ class FB303HandlerTask(ThriftHandlerTask):
         messages.extend(self.service.getWarnings().values())
         return '\n'.join(messages)
 
+    def _getSnapshotTask(self):
+        """Returns the `CounterSnapshotTask`, if it's running, or None"""
+        return self.service.findTask(CounterSnapshotTask)
+
     def getCounters(self):
+        snapshot_task = self._getSnapshotTask()
+        if snapshot_task is not None:
+            result = snapshot_task.getIntSnapshot()
+            if result is not None:
+                result = dict(result)
+                self._addSnapshotAge(snapshot_task, result)
+                return result
+
+        return self._getIntCounters(self.service.getCounters())
+
+    def _addSnapshotAge(self, snapshot_task, result):
+        """Adds the live age of the snapshot being served to `result`"""
+        age = snapshot_task.getSnapshotAgeMs()
+        if age is not None:
+            result[snapshot_task.age_counter_name] = int(age)
+
+    def _getIntCounters(self, callbacks):
+        """Evaluates `callbacks` to ints, preferring snapshot values if any"""
+        snapshot = None
+        snapshot_task = self._getSnapshotTask()
+        if snapshot_task is not None:
+            snapshot = snapshot_task.getSnapshot()
+
         result = {}
-        for k, v in iteritems(self.service.getCounters()):
-            v = v()
+        for k, v in iteritems(callbacks):
+            if snapshot is not None and k in snapshot:
+                v = snapshot[k]
+            else:
+                v = v()
             if v is None:
                 continue
             result[k] = int(v)
         return result
 
+    def getCountersSince(self, cursor):
+        """Returns a `ChangeSet` of int counter values changed since `cursor`
+
+        Deltas require a running `CounterSnapshotTask`; without one, this
+        always returns every counter, with `full` set."""
+        snapshot_task = self._getSnapshotTask()
+        if snapshot_task is None:
+            return ChangeSet(self.getCounters(), 0, True)
+
+        changes = snapshot_task.getSnapshotSince(cursor)
+        values = dict((k, v if v is None else int(v))
+                      for k, v in iteritems(changes.values))
+        self._addSnapshotAge(snapshot_task, values)
+        return changes._replace(values=values)
+
+    def getSelectedCounters(self, keys):
+        return self._getIntCounters(self.service.getSelectedCounters(keys))
+
+    def getRegexCounters(self, regex):
+        return self._getIntCounters(self.service.getRegexCounters(regex))
+
+    def getCounterHistory(self, name, start, end):
+        """Returns [(ts, value), ...] for counter `name` from start to end
+
+        Requires a running `CounterHistoryTask`."""
+        history_task = self.service.findTask(CounterHistoryTask)
+        if history_task is None:
+            raise ValueError("CounterHistoryTask is not running")
+        return history_task.getHistory(name, start, end)
+
     def getCounter(self, name):
-        result = self.service.getCounter(name)()
+        result = None
+        snapshot_task = self._getSnapshotTask()
+        if snapshot_task is not None:
+            result = snapshot_task.getSnapshotValue(name)
+
+        # Fall back to the live value for counters not in the snapshot
+        if result is None:
+            result = self.service.getCounter(name)()
         if result is None:
             raise ValueError("%s is None" % (name))
         return int(result)
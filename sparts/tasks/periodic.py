@@ -25,7 +25,9 @@ class PeriodicTask(VTask):
     INTERVAL = None
 
     execute_duration_ms = samples(windows=[60, 240],
-       types=[SampleType.AVG, SampleType.MAX, SampleType.MIN])
+       types=[SampleType.AVG, SampleType.MAX, SampleType.MIN,
+              SampleType.P50, SampleType.P90, SampleType.P99,
+              SampleType.P999])
     n_iterations = counter()
     n_slow_iterations = counter()
     n_try_later = counter()
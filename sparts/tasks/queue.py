@@ -8,7 +8,8 @@
 from concurrent.futures import Future
 from six.moves import queue
 from sparts.collections import PriorityQueue, UniqueQueue
-from sparts.counters import counter, samples, SampleType, CallbackCounter
+from sparts.counters import sharded_counter, samples, SampleType, \
+    CallbackCounter
 from sparts.sparts import option
 from sparts.vtask import VTask, ExecuteContext, TryLater
 
@@ -25,10 +26,12 @@ class QueueTask(VTask):
                           'its queue. [%(default)s]')
 
     execute_duration_ms = samples(windows=[60, 240],
-       types=[SampleType.AVG, SampleType.MAX, SampleType.MIN])
-    n_trylater = counter()
-    n_completed = counter()
-    n_unhandled = counter()
+       types=[SampleType.AVG, SampleType.MAX, SampleType.MIN,
+              SampleType.P50, SampleType.P90, SampleType.P99,
+              SampleType.P999])
+    n_trylater = sharded_counter()
+    n_completed = sharded_counter()
+    n_unhandled = sharded_counter()
 
     def execute(self, item, context):
         """Implement this in your QueueTask subclasses"""
@@ -0,0 +1,117 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+"""Module that serves counter deltas and history as JSON over tornado HTTP"""
+from __future__ import absolute_import
+
+from six import iteritems
+from sparts.collections import ChangeSet
+from sparts.tasks.counters import CounterHistoryTask, CounterSnapshotTask
+from sparts.tasks.tornado import TornadoHTTPTask
+
+import time
+import tornado.web
+
+
+class ChangeSetHandler(tornado.web.RequestHandler):
+    """A WebRequest handler that renders a `ChangeSet` as JSON.
+
+    Clients pass `?cursor=0` on their first poll, and the returned `cursor`
+    thereafter.  This handler MUST be initialized with a `getter` kwarg,
+    taking the cursor and returning a `ChangeSet`.
+    """
+    def initialize(self, getter):
+        self.getter = getter
+
+    def get(self):
+        try:
+            cursor = int(self.get_argument('cursor', '0'))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'cursor must be an integer')
+        self.write(self.getter(cursor)._asdict())
+
+
+class CounterHistoryHandler(tornado.web.RequestHandler):
+    """A WebRequest handler that renders a counter's history as JSON.
+
+    Takes the counter's `name`, and optional `start` and `end` timestamps,
+    defaulting to the last `DEFAULT_RANGE` seconds.  This handler MUST be
+    initialized with a `task` kwarg (providing `getCounterHistory()`).
+    """
+    DEFAULT_RANGE = 600
+
+    def initialize(self, task):
+        self.task = task
+
+    def get(self):
+        name = self.get_argument('name')
+        try:
+            end = float(self.get_argument('end', time.time()))
+            start = float(self.get_argument('start',
+                                            end - self.DEFAULT_RANGE))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'start and end must be numbers')
+
+        history = self.task.getCounterHistory(name, start, end)
+        if history is None:
+            raise tornado.web.HTTPError(404, 'CounterHistoryTask is not '
+                                             'running')
+        # A list isn't a valid top level JSON response for tornado
+        self.write({'name': name, 'values': history})
+
+
+class CountersHTTPTask(TornadoHTTPTask):
+    """Serves counter and exported value deltas, and counter history, as JSON
+
+    GET /counters/since?cursor=N returns the counters changed since the
+    cursor (see `CounterSnapshotTask.getSnapshotSince()`), and
+    /values/since?cursor=N the exported values (see
+    `VService.getExportedValuesSince()`).  Both return an object with
+    `values`, `cursor` and `full` keys.
+
+    Counter deltas require a running `CounterSnapshotTask`.  Without one,
+    every counter is returned, with `full` set.
+
+    With a `CounterHistoryTask` running, GET
+    /counters/history?name=NAME&start=TS&end=TS returns a counter's
+    recorded `values`, as a list of [ts, value] pairs."""
+    OPT_PREFIX = 'counters_http'
+
+    def getApplicationConfig(self):
+        return [
+            ('/counters/since', ChangeSetHandler,
+             dict(getter=self.getCountersSince)),
+            ('/values/since', ChangeSetHandler,
+             dict(getter=self.service.getExportedValuesSince)),
+            ('/counters/history', CounterHistoryHandler, dict(task=self)),
+        ]
+
+    def getCountersSince(self, cursor):
+        """Returns a `ChangeSet` of counter values changed since `cursor`"""
+        snapshot_task = self.service.findTask(CounterSnapshotTask)
+        if snapshot_task is None:
+            values = {}
+            for k, v in iteritems(self.service.getCounters()):
+                v = v()
+                if v is not None:
+                    values[k] = v
+            return ChangeSet(values, 0, True)
+
+        changes = snapshot_task.getSnapshotSince(cursor)
+        # The snapshot's age is only meaningful when served live
+        age = snapshot_task.getSnapshotAgeMs()
+        if age is not None:
+            changes.values[snapshot_task.age_counter_name] = age
+        return changes
+
+    def getCounterHistory(self, name, start, end):
+        """Returns [(ts, value), ...] for counter `name` from start to end
+
+        Returns None if no `CounterHistoryTask` is running."""
+        history_task = self.service.findTask(CounterHistoryTask)
+        if history_task is None:
+            return None
+        return history_task.getHistory(name, start, end)
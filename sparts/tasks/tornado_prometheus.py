@@ -0,0 +1,67 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+"""Module that serves a service's counters to Prometheus over tornado HTTP"""
+from __future__ import absolute_import
+
+from sparts import prometheus
+from sparts.counters import counter
+from sparts.sparts import option
+from sparts.tasks.tornado import TornadoHTTPTask
+
+import time
+import tornado.web
+
+
+class PrometheusHandler(tornado.web.RequestHandler):
+    """A WebRequest handler that renders counters in the Prometheus format.
+
+    This handler MUST be initialized with a `task` kwarg (providing
+    `getMetricsText()`) in an application config that includes it.
+    """
+    def initialize(self, task):
+        self.task = task
+
+    def get(self):
+        self.set_header('Content-Type', prometheus.CONTENT_TYPE)
+        self.write(self.task.getMetricsText())
+
+
+class PrometheusHTTPTask(TornadoHTTPTask):
+    """Serves the service's counters at /metrics, in the Prometheus format
+
+    The rendered page is cached for --prometheus-ttl seconds, so that many
+    scrapers don't each walk (and evaluate) every counter."""
+    OPT_PREFIX = 'prometheus'
+    DEFAULT_TTL = 5.0
+    DEFAULT_PREFIX = ''
+
+    ttl = option(type=float, metavar='SECONDS',
+                 default=lambda cls: cls.DEFAULT_TTL,
+                 help='How long to cache rendered metrics [%(default)s] (s)')
+    prefix = option(metavar='PREFIX', default=lambda cls: cls.DEFAULT_PREFIX,
+                    help='Prefix to add to metric names [%(default)s]')
+
+    n_renders = counter()
+
+    def initTask(self):
+        self._rendered = (None, None)
+        super(PrometheusHTTPTask, self).initTask()
+
+    def getApplicationConfig(self):
+        return [
+            ('/metrics', PrometheusHandler, dict(task=self)),
+        ]
+
+    def getMetricsText(self):
+        """Returns the rendered metrics, re-rendering them if they're stale"""
+        now = time.time()
+        rendered_at, text = self._rendered
+        if text is None or now - rendered_at >= self.ttl:
+            text = prometheus.render(self.service, self.prefix)
+            self._rendered = (now, text)
+            self.n_renders.increment()
+        return text
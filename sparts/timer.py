@@ -5,13 +5,35 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 #
 """Sparts module implementing a basic timer class"""
+from __future__ import absolute_import
+
 import time
 from datetime import timedelta
+from sparts.compat import OrderedDict, perf_counter
 
 class Timer(object):
-    """Basic Timer class that can be used as a context manager."""
+    """Basic Timer class that can be used as a context manager.
+
+    Times are measured with a monotonic, high-resolution clock (see
+    `sparts.compat.perf_counter`), so they're only meaningful relative to
+    each other, not as wall-clock timestamps.
+
+    Parts of the timed work can be broken down with (nestable) `span()`s:
+
+        with Timer() as t:
+            with t.span('parse'):
+                with t.span('tokenize'):
+                    ...
+            with t.span('execute'):
+                ...
+
+    After which `t.spans` maps 'parse', 'parse.tokenize' and 'execute' to
+    the seconds spent in each.
+    """
     def __init__(self):
         self.start_time = self.end_time = None
+        self.spans = OrderedDict()
+        self._span_stack = []
 
     def __enter__(self):
         """ContextManager protocol enter to start the timer"""
@@ -23,7 +45,11 @@ class Timer(object):
         self.stop()
 
     def start(self):
-        """Explicitly start/restart the timer"""
+        """Explicitly start/restart the timer
+
+        Restarting discards the spans recorded by the previous run."""
+        self.spans = OrderedDict()
+        self._span_stack = []
         self.start_time = self._time()
 
     def stop(self):
@@ -49,7 +75,60 @@ class Timer(object):
 
     def _time(self):
         """Private-ish time to help with mocking/unittests"""
-        return time.time()
+        return perf_counter()
+
+    def span(self, name):
+        """Returns a context manager that times the `name` part of this work
+
+        Spans opened inside other spans are named after their parents, e.g.,
+        'parse.tokenize'.  Spans with the same name add up."""
+        if self._span_stack:
+            name = self._span_stack[-1].name + '.' + name
+        return _Span(self, name)
+
+    def recordSpans(self, samples):
+        """Adds each span's duration (in ms) to `samples[name]`, if present
+
+        `samples` is a dict (or similar) of span names to `samples()`
+        counters, to aggregate the breakdowns of many requests."""
+        for name, elapsed in self.spans.items():
+            counter = samples.get(name)
+            if counter is not None:
+                counter.add(elapsed * 1000.0)
+
+    def dump(self):
+        """Returns a human-readable breakdown of this timer's spans
+
+        Intended for logging the details of slow requests."""
+        lines = ['total: %.3fms' % (self.elapsed * 1000.0)]
+        for name, elapsed in self.spans.items():
+            lines.append('%s%s: %.3fms' % ('  ' * (name.count('.') + 1),
+                                            name.rpartition('.')[2],
+                                            elapsed * 1000.0))
+        return '\n'.join(lines)
+
+
+class _Span(object):
+    """Context manager returned by `Timer.span()`"""
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        timer = self.timer
+        timer._span_stack.append(self)
+        # Register the span now, so parents are listed before children
+        timer.spans.setdefault(self.name, 0.0)
+        self.start = timer._time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timer = self.timer
+        timer.spans[self.name] += timer._time() - self.start
+        timer._span_stack.pop()
 
 
 def run_until_true(f, timeout):
@@ -15,18 +15,19 @@ from __future__ import print_function
 import copy
 import functools
 import logging
-import re
 import signal
 import sys
 import threading
 import time
 
 from argparse import ArgumentParser
+from bisect import bisect_left, insort
+from .collections import ChangeLog, ChangeSet
 from .compat import OrderedDict, captureWarnings
 
 from sparts import vtask
 from .deps import HAS_PSUTIL, HAS_DAEMONIZE
-from .sparts import _SpartsObject, option
+from .sparts import _SpartsObject, _compile_regex, _iter_prefix, option
 
 from sparts import daemon
 
@@ -37,6 +38,7 @@ class VService(_SpartsObject):
     DEFAULT_LOGFILE = None
     DEFAULT_PID = lambda cls: '/var/run/%s.pid' % cls.__name__
     REGISTER_SIGNAL_HANDLERS = True
+    INIT_WORKERS = 0
     TASKS = []
     VERSION = ''
     _name = None
@@ -46,6 +48,12 @@ class VService(_SpartsObject):
                      help='Log to this file instead of stderr.  None or "" '
                           'logs to stderr [%(default)s]')
 
+    init_workers = option(type=int, metavar='N',
+                          default=lambda cls: cls.INIT_WORKERS,
+                          help='Initialize independent tasks concurrently, '
+                               'in N threads.  0 initializes tasks one at a '
+                               'time [%(default)s]')
+
     register_tasks = option(name='tasks', default=None,
                             metavar='TASK', nargs='*',
                             help='Tasks to run.  Pass without args to see the '
@@ -103,6 +111,9 @@ class VService(_SpartsObject):
 
         # Register exported values API
         self.exported_values = {}
+        self.exported_values_log = ChangeLog()
+        self._exported_keys = []
+        self._exported_keys_lock = threading.Lock()
 
         # Set start_time for aliveSince() calls
         self.start_time = time.time()
@@ -164,7 +175,7 @@ class VService(_SpartsObject):
         self.initService()
 
         # Initialize the tasks
-        self.tasks.init()
+        self.tasks.init(workers=self.getOption('init_workers'))
 
     def _handleShutdownSignals(self, signum, frame):
         assert signum in (signal.SIGINT, signal.SIGTERM)
@@ -191,6 +202,15 @@ class VService(_SpartsObject):
         """Returns a task for the given class `name` or type, or throws."""
         return self.tasks.require(name)
 
+    def findTask(self, cls):
+        """Returns the first task that is an instance of `cls`, or None.
+
+        Unlike `getTask()`, this also finds tasks that subclass `cls`."""
+        for task in self.tasks:
+            if isinstance(task, cls):
+                return task
+        return None
+
     def shutdown(self):
         """Request a graceful shutdown.  Does not block."""
         self.logger.info("Received graceful shutdown request")
@@ -379,19 +399,43 @@ class VService(_SpartsObject):
         return self.exported_values.get(name, '')
 
     def setExportedValue(self, name, value):
+        # Keep a sorted index of keys for prefix (and regex) lookups
+        with self._exported_keys_lock:
+            if value is None:
+                del self.exported_values[name]
+                del self._exported_keys[bisect_left(self._exported_keys,
+                                                    name)]
+            else:
+                if name not in self.exported_values:
+                    insort(self._exported_keys, name)
+                self.exported_values[name] = value
         if value is None:
-            del self.exported_values[name]
+            self.exported_values_log.record((), removed=(name, ))
         else:
-            self.exported_values[name] = value
+            self.exported_values_log.record((name, ))
 
     def getExportedValues(self):
         return copy.copy(self.exported_values)
 
+    def getExportedValuesSince(self, cursor):
+        """Returns a `ChangeSet` of exported values changed since `cursor`
+
+        Pass 0 as the initial cursor, and the returned `cursor` thereafter.
+        """
+        keys, version = self.exported_values_log.changedSince(cursor)
+        if keys is None:
+            return ChangeSet(self.getExportedValues(), version, True)
+        return ChangeSet(dict((k, self.exported_values.get(k)) for k in keys),
+                         version, False)
+
     def getRegexExportedValues(self, regex):
-        matcher = re.compile(regex)
-        keys = [key for key in self.exported_values.keys()
-                if matcher.match(key) is not None]
-        return self.getSelectedExportedValues(keys)
+        # Only keys sharing the pattern's literal prefix can match
+        matcher, prefix = _compile_regex(regex)
+        with self._exported_keys_lock:
+            keys = [key for key in _iter_prefix(self._exported_keys, prefix)
+                    if matcher.match(key) is not None]
+        values = self.exported_values
+        return dict((key, values.get(key, '')) for key in keys)
 
     def getSelectedExportedValues(self, keys):
         return dict([(key, self.getExportedValue(key))
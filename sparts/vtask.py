@@ -15,6 +15,7 @@ import logging
 import six
 import threading
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from six.moves import xrange
 from sparts.sparts import _SpartsObject
 from sparts.timer import Timer
@@ -308,24 +309,27 @@ class Tasks(object):
         self._created.remove(task)
         del(self._created_names[task.name])
 
-    def init(self):
-        """Initialize all created tasks.  Remove ones that throw SkipTask."""
+    def init(self, workers=0):
+        """Initialize all created tasks.  Remove ones that throw SkipTask.
+
+        If `workers` is non-zero, tasks are initialized concurrently in that
+        many threads, as soon as the tasks in their `DEPS` have been
+        initialized."""
         assert self._did_create
         exceptions = []
         skipped = []
 
-        for t in self:
-            try:
-                t.initTask()
-            except SkipTask as e:
+        if workers:
+            results = self._initParallel(workers)
+        else:
+            results = [(t, self._initTask(t)) for t in self]
+
+        for t, e in results:
+            if isinstance(e, SkipTask):
                 # Keep track of SkipTasks so we can remove it from this
                 # task collection
-                self.logger.info("Skipping %s (%s)", t.name, e)
                 skipped.append(t)
-            except Exception as e:
-                # Log and track unhandled exceptions during init, so we can
-                # fail later.
-                self.logger.exception("Error creating task, %s", t.name)
+            elif e is not None:
                 exceptions.append(e)
 
         # Remove any tasks that should be skipped
@@ -337,6 +341,52 @@ class Tasks(object):
             raise Exception("Unable to start service (%d task start errors)" %
                             len(exceptions))
 
+    def _initTask(self, t):
+        """Calls `t.initTask()`, returning the exception it raised, if any"""
+        try:
+            t.initTask()
+        except SkipTask as e:
+            self.logger.info("Skipping %s (%s)", t.name, e)
+            return e
+        except Exception as e:
+            # Log and track unhandled exceptions during init, so we can
+            # fail later.
+            self.logger.exception("Error creating task, %s", t.name)
+            return e
+        return None
+
+    def _initParallel(self, workers):
+        """Initialize tasks in a thread pool, respecting `DEPS` ordering.
+
+        Returns a list of (task, exception or None)."""
+        tasks = self.tasks
+        waiting_on = {}
+        for t in tasks:
+            deps = [self._created_names.get(dep.__name__) for dep in t.DEPS]
+            waiting_on[t] = set(dep for dep in deps if dep is not None)
+
+        results = []
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while waiting_on or running:
+                # Start every task whose dependencies are all initialized
+                for t in tasks:
+                    if t in waiting_on and not waiting_on[t]:
+                        del waiting_on[t]
+                        running[executor.submit(self._initTask, t)] = t
+
+                assert running, "Cyclic DEPS among %s" % list(waiting_on)
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for f in done:
+                    t = running.pop(f)
+                    results.append((t, f.result()))
+                    for deps in waiting_on.values():
+                        deps.discard(t)
+        finally:
+            executor.shutdown(wait=True)
+        return results
+
     def start(self):
         """Start all the tasks, creating worker threads, etc"""
         assert self._did_create
@@ -0,0 +1,375 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+from sparts.counters import counter, keyed_counter, samples, SampleType
+from sparts.fileutils import NamedTemporaryDirectory
+from sparts.tasks.counters import CounterSnapshotTask, MetricsExporterTask, \
+    CounterHistoryTask, SharedCountersTask, _SharedCounterTable
+from sparts.tests.base import MultiTaskTestCase
+from sparts.vtask import VTask
+
+import os
+import socket
+import time
+
+
+class CountingTask(VTask):
+    LOOPLESS = True
+    n_things = counter()
+    n_others = counter()
+
+
+class SlowSnapshotTask(CounterSnapshotTask):
+    # Keep the background thread out of the way; tests call execute()
+    INTERVAL = 3600.0
+
+
+class TestCounterSnapshotTask(MultiTaskTestCase):
+    TASKS = [SlowSnapshotTask, CountingTask]
+
+    def setUp(self):
+        super(TestCounterSnapshotTask, self).setUp()
+        self.task = self.service.requireTask('SlowSnapshotTask')
+        self.counting = self.service.requireTask('CountingTask')
+        self.task.execute()
+
+    def test_snapshot(self):
+        before = self.task.getSnapshotValue('CountingTask.n_things')
+        self.counting.n_things.incrementBy(5)
+        self.assertEqual(self.task.getSnapshotValue('CountingTask.n_things'),
+                         before)
+
+        self.task.execute()
+        snapshot = self.task.getSnapshot()
+        self.assertEqual(snapshot['CountingTask.n_things'], before + 5)
+        self.assertEqual(self.task.getSnapshotValue('missing', 'x'), 'x')
+
+    def test_int_snapshot_cached(self):
+        self.counting.n_things.incrementBy(2.5)
+        self.task.execute()
+        ints = self.task.getIntSnapshot()
+        self.assertEqual(ints['CountingTask.n_things'],
+                         int(self.counting.n_things.getvalue()))
+        self.assertIs(self.task.getIntSnapshot(), ints)
+
+        self.task.execute()
+        self.assertIsNot(self.task.getIntSnapshot(), ints)
+
+    def test_snapshot_age(self):
+        age = self.service.getCounter('SlowSnapshotTask.snapshot_age_ms')()
+        self.assertGreaterEqual(age, 0.0)
+        self.assertLess(age, 60000.0)
+
+        # The (always stale) captured age is not part of the snapshot
+        self.assertNotIn('SlowSnapshotTask.snapshot_age_ms',
+                         self.task.getSnapshot())
+
+    def test_snapshot_since(self):
+        changes = self.task.getSnapshotSince(0)
+        self.assertTrue(changes.full)
+        self.assertIn('CountingTask.n_things', changes.values)
+
+        # Nothing changed between these snapshots
+        self.task.execute()
+        changes = self.task.getSnapshotSince(changes.cursor)
+        self.assertFalse(changes.full)
+        self.assertNotIn('CountingTask.n_things', changes.values)
+
+        self.counting.n_things.increment()
+        self.task.execute()
+        changes = self.task.getSnapshotSince(changes.cursor)
+        self.assertFalse(changes.full)
+        self.assertEqual(changes.values['CountingTask.n_things'],
+                         self.counting.n_things.getvalue())
+
+        # Up-to-date cursors get an empty delta
+        changes = self.task.getSnapshotSince(changes.cursor)
+        self.assertEqual(changes.values, {})
+
+        # Cursors from a previous process get a full refresh
+        changes = self.task.getSnapshotSince(changes.cursor + 1)
+        self.assertTrue(changes.full)
+
+
+class SlowMetricsExporterTask(MetricsExporterTask):
+    OPT_PREFIX = 'metrics'
+    MAX_DATAGRAM = 128
+
+    def _runloop(self):
+        # Tests call execute() directly
+        self.stop_event.wait()
+
+
+class TestMetricsExporterTask(MultiTaskTestCase):
+    TASKS = [SlowMetricsExporterTask, CountingTask]
+
+    def getCreateArgs(self):
+        return ['--metrics-port', str(self.listener.getsockname()[1]),
+                '--metrics-prefix', 'test.']
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(3.0)
+        super(TestMetricsExporterTask, self).setUp()
+        self.task = self.service.requireTask('SlowMetricsExporterTask')
+        self.counting = self.service.requireTask('CountingTask')
+
+    def tearDown(self):
+        super(TestMetricsExporterTask, self).tearDown()
+        self.listener.close()
+
+    def receive(self, n_datagrams):
+        lines = []
+        for i in range(n_datagrams):
+            datagram = self.listener.recv(65536)
+            # Only metrics that don't fit on their own exceed MAX_DATAGRAM
+            if len(datagram) > self.task.MAX_DATAGRAM:
+                self.assertNotIn(b'\n', datagram)
+            lines.extend(datagram.decode('utf-8').split('\n'))
+        return dict(line.rsplit('|', 1)[0].split(':', 1) for line in lines)
+
+    def execute(self):
+        """Returns the metrics received from one `execute()` call"""
+        n_datagrams = self.task.n_sent_datagrams.getvalue()
+        n_metrics = self.task.n_sent_metrics.getvalue()
+        self.task.execute()
+        metrics = self.receive(
+            int(self.task.n_sent_datagrams.getvalue() - n_datagrams))
+        self.assertEqual(len(metrics),
+                         self.task.n_sent_metrics.getvalue() - n_metrics)
+        return metrics
+
+    def test_export(self):
+        n_datagrams = self.task.n_sent_datagrams.getvalue()
+        metrics = self.execute()
+        self.assertGreater(self.task.n_sent_datagrams.getvalue(),
+                           n_datagrams + 1)
+        self.assertEqual(float(metrics['test.CountingTask.n_things']),
+                         self.counting.n_things.getvalue())
+
+        self.assertIn('test.CountingTask.n_others', metrics)
+
+        # Only changed counters are resent
+        self.counting.n_things.increment()
+        metrics = self.execute()
+        self.assertIn('test.CountingTask.n_things', metrics)
+        self.assertNotIn('test.CountingTask.n_others', metrics)
+        self.assertEqual(self.task.n_dropped_metrics.getvalue(), 0)
+
+    def test_format(self):
+        self.assertEqual(self.task.formatMetric('a b:c', 2.0),
+                         'test.a_b_c:2|g')
+        self.assertEqual(self.task.formatMetric('x', 0.5), 'test.x:0.5|g')
+        self.assertIs(self.task.formatMetric('x', float('nan')), None)
+
+
+class KeyedTask(VTask):
+    LOOPLESS = True
+    n_requests = keyed_counter()
+
+
+class SlowCounterHistoryTask(CounterHistoryTask):
+    OPT_PREFIX = 'counter_history'
+    DEFAULT_MAX_COUNTERS = 64
+    RESOLUTIONS = [(1, 120), (60, 10)]
+
+    def _runloop(self):
+        # Tests call record() directly
+        self.stop_event.wait()
+
+
+class TestCounterHistoryTask(MultiTaskTestCase):
+    TASKS = [SlowCounterHistoryTask, CountingTask, KeyedTask]
+
+    def getCreateArgs(self):
+        return ['--counter-history-path', self.tmpdir.name]
+
+    def setUp(self):
+        self.tmpdir = NamedTemporaryDirectory(prefix='counter_history_')
+        super(TestCounterHistoryTask, self).setUp()
+        self.task = self.service.requireTask('SlowCounterHistoryTask')
+        self.counting = self.service.requireTask('CountingTask')
+
+    def tearDown(self):
+        super(TestCounterHistoryTask, self).tearDown()
+        self.tmpdir.close()
+
+    def test_history(self):
+        name = 'CountingTask.n_others'
+        base = self.counting.n_others.getvalue()
+        now = int(time.time() // 60) * 60.0
+        for i in range(3):
+            self.task.record(now + i)
+            self.counting.n_others.increment()
+
+        self.assertEqual(self.task.getHistory(name, now, now + 2),
+                         [(now, base), (now + 1, base + 1),
+                          (now + 2, base + 2)])
+        self.assertEqual(self.task.getHistory('missing', now, now + 2), [])
+
+        # Frames older than the ring's retention are overwritten
+        self.task.record(now + 120)
+        self.assertEqual(self.task.rings[0].read(
+            self.task.columns[name], now, now + 120),
+            [(now + 1, base + 1), (now + 2, base + 2), (now + 120, base + 3)])
+
+        # The minutely rollup averages each minute's samples
+        self.assertEqual(self.task.rings[1].read(
+            self.task.columns[name], now, now + 120),
+            [(now, base + 1), (now + 120, base + 3)])
+
+    def test_files(self):
+        self.task.record(time.time())
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)),
+                         ['1s.ring', '60s.ring', 'names'])
+        self.assertEqual(os.path.getsize(self.tmpdir.join('1s.ring')),
+                         120 * 65 * 8)
+        with open(self.tmpdir.join('names')) as f:
+            names = f.read().splitlines()
+        self.assertEqual(sorted(names), sorted(self.task.columns))
+
+    def test_dynamic_counters(self):
+        keyed = self.service.requireTask('KeyedTask')
+        for i in range(100):
+            keyed.n_requests.increment('key%d' % i)
+        untracked = self.task.n_untracked_counters.getvalue()
+        self.task.record(time.time())
+        self.assertIn('CountingTask.n_others', self.task.columns)
+        self.assertFalse([name for name in self.task.columns
+                          if name.startswith('KeyedTask.')])
+        self.assertEqual(self.task.n_untracked_counters.getvalue(), untracked)
+
+    def test_max_counters_changed(self):
+        self.task.record(time.time())
+        self.assertGreater(len(self.task.columns), 2)
+
+        # Restart with fewer columns than were assigned
+        self.task._closeFiles()
+        self.task.max_counters = 2
+        self.task._openFiles()
+        self.assertEqual(self.task.columns, {})
+        with open(self.tmpdir.join('names')) as f:
+            self.assertEqual(f.read(), '')
+
+        now = time.time()
+        self.task.record(now)
+        self.assertEqual(len(self.task.columns), 2)
+        name = sorted(self.task.columns, key=self.task.columns.get)[0]
+        self.assertEqual(len(self.task.getHistory(name, now - 1, now)), 1)
+
+
+class SlowSharedCountersTask(SharedCountersTask):
+    OPT_PREFIX = 'shared_counters'
+    DEFAULT_SLOTS = 4
+    DEFAULT_MAX_COUNTERS = 64
+
+    def _runloop(self):
+        # Tests call publish() directly
+        self.stop_event.wait()
+
+
+class SamplingTask(VTask):
+    LOOPLESS = True
+    latency_ms = samples(windows=[60], types=[SampleType.AVG, SampleType.MAX,
+                                              SampleType.COUNT])
+
+
+class TestSharedCountersTask(MultiTaskTestCase):
+    TASKS = [SlowSharedCountersTask, CountingTask, SamplingTask, KeyedTask]
+
+    def getCreateArgs(self):
+        return ['--shared-counters-path', self.tmpdir.join('counters')]
+
+    def setUp(self):
+        self.tmpdir = NamedTemporaryDirectory(prefix='shared_counters_')
+        super(TestSharedCountersTask, self).setUp()
+        self.task = self.service.requireTask('SlowSharedCountersTask')
+        self.counting = self.service.requireTask('CountingTask')
+
+    def tearDown(self):
+        super(TestSharedCountersTask, self).tearDown()
+        self.tmpdir.close()
+
+    def test_shared_counters(self):
+        name = 'CountingTask.n_others'
+        value = self.counting.n_others.getvalue()
+        self.task.publish(time.time())
+        self.assertEqual(self.service.getCounter(
+            'SlowSharedCountersTask.total.' + name)(), value)
+
+        # Simulate another worker process sharing the same file
+        other = _SharedCounterTable(self.tmpdir.join('counters'), 1, 1)
+        self.assertEqual(other.slots, self.task.table.slots)
+        self.assertEqual(other.names(), self.task.table.names())
+        slot = other.claim(-1, time.time(), 3.0)
+        self.assertNotEqual(slot, self.task.slot)
+        values = [float('nan')] * other.width
+        values[other.getColumn(name)] = 10.0
+        values[other.getColumn('other.only')] = 2.0
+        values[other.getColumn('other.only.count')] = 1.0
+        other.write(slot, -1, time.time(), values)
+
+        counters = self.service.getCounters()
+        prefix = 'SlowSharedCountersTask.'
+        self.assertEqual(counters[prefix + 'total.' + name](), value + 10.0)
+        # Names only known to the other worker are combined by their suffix
+        self.assertEqual(counters[prefix + 'total.other.only.count'](), 1.0)
+        self.assertNotIn(prefix + 'total.other.only', counters)
+        self.assertEqual(
+            counters[prefix + 'worker.%d.other.only' % slot](), 2.0)
+        self.assertEqual(
+            counters[prefix + 'worker.%d.%s' % (slot, name)](), 10.0)
+        self.assertEqual(
+            counters[prefix + 'worker.%d.%s' % (self.task.slot, name)](),
+            value)
+
+        # Stale workers are ignored
+        totals, workers = self.task.getSharedCounters(time.time() + 60)
+        self.assertEqual(totals, {})
+        other.release(slot)
+        other.close()
+
+    def test_shared_samples(self):
+        prefix = 'SamplingTask.latency_ms.'
+        self.service.requireTask('SamplingTask').latency_ms.add(4.0)
+        self.task.publish(time.time())
+
+        other = _SharedCounterTable(self.tmpdir.join('counters'), 1, 1)
+        slot = other.claim(-1, time.time(), 3.0)
+        values = [float('nan')] * other.width
+        for name, value in [('avg.60', 10.0), ('max.60', 10.0),
+                            ('count.60', 1.0)]:
+            values[other.getColumn(prefix + name)] = value
+        other.write(slot, -1, time.time(), values)
+
+        totals, workers = self.task.getSharedCounters()
+        # Averages can't be combined, so they're only reported per worker
+        self.assertNotIn(prefix + 'avg.60', totals)
+        self.assertEqual(workers[slot][prefix + 'avg.60'], 10.0)
+        self.assertEqual(workers[self.task.slot][prefix + 'avg.60'], 4.0)
+        # Maxes take the max, and counts are summed
+        self.assertEqual(totals[prefix + 'max.60'], 10.0)
+        self.assertEqual(totals[prefix + 'count.60'], 2.0)
+        other.release(slot)
+        other.close()
+
+    def test_dynamic_counters(self):
+        keyed = self.service.requireTask('KeyedTask')
+        for i in range(100):
+            keyed.n_requests.increment('key%d' % i)
+        self.task.publish(time.time())
+        self.task.publish(time.time())
+
+        names = self.task.table.names()
+        self.assertIn('CountingTask.n_others', names)
+        # Neither churning keys, nor the shared values themselves, take up
+        # names in the table
+        prefix = 'SlowSharedCountersTask.'
+        self.assertFalse([name for name in names
+                          if name.startswith(('KeyedTask.',
+                                              prefix + 'total.',
+                                              prefix + 'worker.'))])
@@ -0,0 +1,124 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+from sparts.tests.base import MultiTaskTestCase, Skip
+
+try:
+    import tornado
+except ImportError:
+    raise Skip("Tornado must be installed to run this test")
+
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import urlopen
+from sparts.counters import counter
+from sparts.fileutils import NamedTemporaryDirectory
+from sparts.tasks.counters import CounterHistoryTask, CounterSnapshotTask
+from sparts.tasks.tornado_counters import CountersHTTPTask
+from sparts.vtask import VTask
+
+import json
+import time
+
+
+class CountingTask(VTask):
+    LOOPLESS = True
+    n_things = counter()
+
+
+class SlowSnapshotTask(CounterSnapshotTask):
+    # Keep the background thread out of the way; tests call execute()
+    INTERVAL = 3600.0
+
+
+class SlowCounterHistoryTask(CounterHistoryTask):
+    OPT_PREFIX = 'counter_history'
+
+    def _runloop(self):
+        # Tests call record() directly
+        self.stop_event.wait()
+
+
+class FetchMixin(object):
+    def fetch(self, path):
+        http = self.service.requireTask(CountersHTTPTask)
+        addr = http.bound_addrs[0]
+        host = '[::1]' if len(addr) == 4 else '127.0.0.1'
+        f = urlopen('http://%s:%s%s' % (host, addr[1], path))
+        return json.loads(f.read().decode('utf-8'))
+
+
+class TestCountersHTTPTask(FetchMixin, MultiTaskTestCase):
+    TASKS = [CountersHTTPTask, SlowSnapshotTask, CountingTask]
+
+    def setUp(self):
+        super(TestCountersHTTPTask, self).setUp()
+        self.snapshot_task = self.service.requireTask(SlowSnapshotTask)
+        self.counting = self.service.requireTask(CountingTask)
+        self.snapshot_task.execute()
+
+    def test_counters_since(self):
+        changes = self.fetch('/counters/since?cursor=0')
+        self.assertTrue(changes['full'])
+        self.assertIn('CountingTask.n_things', changes['values'])
+        self.assertIn('SlowSnapshotTask.snapshot_age_ms', changes['values'])
+
+        self.counting.n_things.increment()
+        self.snapshot_task.execute()
+        changes = self.fetch('/counters/since?cursor=%d' % changes['cursor'])
+        self.assertFalse(changes['full'])
+        self.assertEqual(changes['values']['CountingTask.n_things'],
+                         self.counting.n_things.getvalue())
+
+    def test_values_since(self):
+        changes = self.fetch('/values/since?cursor=0')
+        self.assertTrue(changes['full'])
+
+        self.service.setExportedValue('color', 'blue')
+        changes = self.fetch('/values/since?cursor=%d' % changes['cursor'])
+        self.assertEqual(changes['values'], {'color': 'blue'})
+        self.assertFalse(changes['full'])
+
+    def test_bad_cursor(self):
+        with self.assertRaises(HTTPError) as ctx:
+            self.fetch('/counters/since?cursor=x')
+        self.assertEqual(ctx.exception.code, 400)
+
+    def test_no_history(self):
+        with self.assertRaises(HTTPError) as ctx:
+            self.fetch('/counters/history?name=CountingTask.n_things')
+        self.assertEqual(ctx.exception.code, 404)
+
+
+class TestCounterHistoryHTTP(FetchMixin, MultiTaskTestCase):
+    TASKS = [CountersHTTPTask, SlowCounterHistoryTask, CountingTask]
+
+    def getCreateArgs(self):
+        return ['--counter-history-path', self.tmpdir.name]
+
+    def setUp(self):
+        self.tmpdir = NamedTemporaryDirectory(prefix='counter_history_')
+        super(TestCounterHistoryHTTP, self).setUp()
+        self.history_task = self.service.requireTask(SlowCounterHistoryTask)
+        self.counting = self.service.requireTask(CountingTask)
+
+    def tearDown(self):
+        super(TestCounterHistoryHTTP, self).tearDown()
+        self.tmpdir.close()
+
+    def test_history(self):
+        name = 'CountingTask.n_things'
+        base = self.counting.n_things.getvalue()
+        now = float(int(time.time()))
+        for i in range(3):
+            self.history_task.record(now + i)
+            self.counting.n_things.increment()
+
+        result = self.fetch('/counters/history?name=%s&start=%d&end=%d' %
+                            (name, now, now + 2))
+        self.assertEqual(result['name'], name)
+        self.assertEqual(result['values'],
+                         [[now, base], [now + 1, base + 1],
+                          [now + 2, base + 2]])
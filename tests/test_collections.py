@@ -4,7 +4,8 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 #
-from sparts.collections import PriorityQueue, UniqueQueue, Duplicate
+from sparts.collections import PriorityQueue, UniqueQueue, Duplicate, \
+    ChangeLog
 from sparts.tests.base import BaseSpartsTestCase
 
 
@@ -94,3 +95,41 @@ class UniqueQueueTests(BaseSpartsTestCase):
         queue.unsee(0)
         queue.put(0)
         self.assertFalse(queue.empty())
+
+
+class ChangeLogTests(BaseSpartsTestCase):
+    def test_many_updates(self):
+        log = ChangeLog()
+        _, cursor = log.changedSince(0)
+
+        # Deltas depend on the keys changed, not on the number of updates
+        for i in range(2000):
+            log.record(['key%d' % (i % 10)])
+        keys, cursor = log.changedSince(cursor)
+        self.assertEqual(sorted(keys), sorted('key%d' % i for i in range(10)))
+
+        log.record(['key3'], removed=['key4'])
+        keys, cursor = log.changedSince(cursor)
+        self.assertEqual(sorted(keys), ['key3', 'key4'])
+
+        keys, _ = log.changedSince(cursor)
+        self.assertEqual(keys, [])
+
+    def test_stale_cursors(self):
+        log = ChangeLog(max_tombstones=2)
+        version = log.record(['a'])
+        self.assertIsNone(log.changedSince(0)[0])
+        self.assertIsNone(log.changedSince(version + 1)[0])
+
+        # Live keys never expire
+        for i in range(100):
+            log.record(['b'])
+        self.assertEqual(sorted(log.changedSince(version - 1)[0]),
+                         ['a', 'b'])
+
+        # Too many tombstones forget the oldest entries
+        removed_x = log.record([], removed=['x'])
+        log.record([], removed=['y'])
+        log.record([], removed=['z'])
+        self.assertIsNone(log.changedSince(removed_x - 1)[0])
+        self.assertEqual(sorted(log.changedSince(removed_x)[0]), ['y', 'z'])
@@ -4,7 +4,8 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 #
-from sparts.tests.base import BaseSpartsTestCase
+from sparts.deps import HAS_NUMPY
+from sparts.tests.base import BaseSpartsTestCase, Skip
 from sparts import counters
 
 import time
@@ -30,6 +31,52 @@ class CounterTests(BaseSpartsTestCase):
         c.reset(0.5)
         self.assertEqual(float(c), 0.5)
 
+    def testShardedSum(self):
+        """Test `counters.ShardedSum()` across threads"""
+        import threading
+        c = counters.ShardedSum()
+        self.assertEqual(c(), 0.0)
+        c.increment()
+        c.incrementBy(10)
+        self.assertEqual(c(), 11.0)
+
+        def work():
+            for i in range(10000):
+                c.increment()
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # No updates are lost, and the shards of the exited threads have been
+        # folded into the base value
+        self.assertEqual(c(), 80011.0)
+        self.assertEqual(len(c._shards), 1)
+        c.increment()
+        self.assertEqual(c(), 80012.0)
+
+        c.reset(0.5)
+        self.assertEqual(float(c), 0.5)
+        c.add(1)
+        self.assertEqual(float(c), 1.5)
+
+    def testSumBatch(self):
+        """Test `counters.Sum().batch()` and its sharded subclass"""
+        for c in [counters.Sum(), counters.ShardedSum()]:
+            with c.batch() as b:
+                for i in range(10):
+                    b += 1
+                # Nothing is applied until the batch is flushed
+                self.assertEqual(c(), 0.0)
+            self.assertEqual(c(), 10.0)
+
+            b.add(5)
+            b.flush()
+            b.flush()
+            self.assertEqual(c(), 15.0)
+
     def testCount(self):
         """Test `counters.Count()"""
         c = counters.Count()
@@ -67,6 +114,21 @@ class CounterTests(BaseSpartsTestCase):
         c.add(20)
         self.assertEqual(c(), 15.0)
 
+    def testPercentile(self):
+        """Test `counters.Percentile()`"""
+        c = counters.Percentile(0.99)
+        self.assertEqual(c.suffix, 'p99')
+        self.assertIs(c(), None)
+        for i in range(1, 1001):
+            c.add(i)
+        # Estimates should be within the histogram's ~1% error
+        self.assertAlmostEqual(c(), 990, delta=10)
+
+        c = counters.Percentile(0.5)
+        for v in [-5, 0, 0, 0, 5]:
+            c.add(v)
+        self.assertEqual(c(), 0.0)
+
     def testCallbackCounter(self):
         """Test `counters.CallbackCounter()`"""
         l = [0.0]
@@ -141,3 +203,492 @@ class CounterTests(BaseSpartsTestCase):
         self.assertEqual(c.getCounter('count.1000'), 0, str((now, c.samples)))
         self.assertEqual(c.getCounter('sum.100'), 0.0)
         self.assertEqual(c.getCounter('sum.1000'), 0.0)
+
+    def testSamplesAddMany(self):
+        c = counters.samples(name='foo',
+            types=[counters.SampleType.COUNT, counters.SampleType.MAX],
+            windows=[100])
+        c._now = self.mock.Mock(return_value=time.time())
+
+        c.add_many([1.0, 5.0, 3.0])
+        with c.batch() as b:
+            b += 7.0
+            b += 2.0
+
+        # One timestamp per call
+        self.assertEqual(c._now.call_count, 2)
+        self.assertEqual(c.getCounter('foo.count.100'), 5)
+        self.assertEqual(c.getCounter('foo.max.100'), 7.0)
+
+    def testSamplesTime(self):
+        c = counters.samples(name='foo',
+            types=[counters.SampleType.COUNT, counters.SampleType.MAX],
+            windows=[100])
+        errors = counters.counter()
+
+        with c.time(errors):
+            with c.time(errors):
+                time.sleep(0.01)
+        with self.assertRaises(ValueError):
+            with c.time(errors):
+                raise ValueError()
+
+        self.assertEqual(c.getCounter('foo.count.100'), 3)
+        self.assertGreaterEqual(c.getCounter('foo.max.100'), 10.0)
+        self.assertEqual(errors(), 1.0)
+        # The context manager is reused
+        self.assertIs(c.time(), c.time())
+
+    def testSamplesTimeNotEntered(self):
+        c = counters.samples(name='foo', types=[counters.SampleType.COUNT],
+                             windows=[100])
+        errors = counters.counter()
+
+        # A `time()` that is never entered must not leak its `errors` into
+        # the next timed block
+        c.time(errors)
+        with self.assertRaises(ValueError):
+            with c.time():
+                raise ValueError()
+        self.assertEqual(errors(), 0.0)
+
+        c.time()
+        with self.assertRaises(ValueError):
+            with c.time(errors):
+                raise ValueError()
+        self.assertEqual(errors(), 1.0)
+        self.assertEqual(c.getCounter('foo.count.100'), 2)
+
+    def testTimed(self):
+        class Parser(object):
+            parse_ms = counters.samples(windows=[100],
+                                        types=[counters.SampleType.COUNT])
+            n_errors = counters.counter()
+
+            @counters.timed('parse_ms', 'n_errors')
+            def parse(self, value):
+                return int(value)
+
+        parser = Parser()
+        self.assertEqual(parser.parse('1'), 1)
+        self.assertRaises(ValueError, parser.parse, 'x')
+        self.assertEqual(parser.parse_ms.getCounter('parse_ms.count.100'), 2)
+        self.assertEqual(parser.n_errors(), 1.0)
+
+    def testSamplePercentiles(self):
+        c = counters.samples(name='latency',
+            types=[counters.SampleType.P50, counters.SampleType.P999],
+            windows=[100])
+        for i in range(1, 101):
+            c.add(i)
+
+        self.assertEqual(sorted(c.getCounters()),
+                         ['latency.p50.100', 'latency.p999.100'])
+        self.assertAlmostEqual(c.getCounter('latency.p50.100'), 50, delta=1)
+        self.assertAlmostEqual(c.getCounter('latency.p999.100'), 100, delta=1)
+
+    def testBucketedSamples(self):
+        c = counters.samples(
+            types=[counters.SampleType.COUNT, counters.SampleType.SUM,
+                   counters.SampleType.MAX, counters.SampleType.P50],
+            windows=[100, 1000], resolution=10)
+
+        now = 1000000.0
+        c._now = self.mock.Mock()
+
+        # Samples within the same 10s bucket share storage
+        c._now.return_value = now
+        c.add(10.0)
+        c.add(20.0)
+        c._now.return_value = now + 5
+        c.add(30.0)
+        self.assertEqual(len(c.samples), 1)
+
+        c._now.return_value = now + 10
+        c.add(40.0)
+        self.assertEqual(len(c.samples), 2)
+
+        self.assertEqual(c.getCounter('count.100'), 4)
+        self.assertEqual(c.getCounter('sum.100'), 100.0)
+        self.assertEqual(c.getCounter('max.100'), 40.0)
+        self.assertAlmostEqual(c.getCounter('p50.100'), 20.0, delta=0.2)
+
+        # At t=110, the first bucket has fallen out of the 100 window
+        c._now.return_value = now + 110
+        self.assertEqual(c.getCounter('count.100'), 1)
+        self.assertEqual(c.getCounter('max.100'), 40.0)
+        self.assertEqual(c.getCounter('count.1000'), 4)
+
+        # The ring never holds more than max_window / resolution buckets
+        for i in range(500):
+            c._now.return_value = now + 200 + 10 * i
+            c.add(1.0)
+        self.assertEqual(len(c.samples), 101)
+        self.assertEqual(c.getCounter('count.1000'), 101)
+        self.assertEqual(c.getCounter('sum.100'), 11.0)
+
+    def testSamplesIncremental(self):
+        """Running window aggregates match a brute force scan"""
+        import random
+        rng = random.Random(42)
+        types = [counters.SampleType.COUNT, counters.SampleType.SUM,
+                 counters.SampleType.MIN, counters.SampleType.MAX]
+        c = counters.samples(types=types, windows=[10, 50])
+        c._now = self.mock.Mock()
+
+        now = 1000.0
+        history = []
+        for i in range(2000):
+            now += rng.random()
+            value = rng.randint(-100, 100)
+            c._now.return_value = now
+            c.add(value)
+            history.append((now, value))
+
+            if i % 97:
+                continue
+            for window in [10, 50]:
+                values = [v for ts, v in history if now - window <= ts]
+                self.assertEqual(c.getCounter('count.%d' % window),
+                                 len(values))
+                self.assertAlmostEqual(c.getCounter('sum.%d' % window),
+                                       sum(values))
+                self.assertEqual(c.getCounter('min.%d' % window),
+                                 min(values))
+                self.assertEqual(c.getCounter('max.%d' % window),
+                                 max(values))
+
+    def testRate(self):
+        c = counters.rate(name='requests', windows=[10, 100])
+        self.assertEqual(sorted(k for k, v in c._genCounterCallbacks()),
+                         ['requests.rate.10', 'requests.rate.100'])
+
+        now = 1000000.0
+        c._now = self.mock.Mock()
+        for i in range(200):
+            c._now.return_value = now + i
+            c.increment()
+            c.incrementBy(2)
+
+        # The rate of a steady stream doesn't depend on when it is read
+        for offset in [0.0, 0.25, 0.5, 0.99]:
+            c._now.return_value = now + 199 + offset
+            self.assertAlmostEqual(c.getCounter('requests.rate.10'), 3.0)
+            self.assertAlmostEqual(c.getCounter('requests.rate.100'), 3.0)
+
+        # Everything falls out of the short window after idling
+        c._now.return_value = now + 250
+        self.assertEqual(c.getCounter('requests.rate.10'), 0.0)
+        self.assertAlmostEqual(c.getCounter('requests.rate.100'), 1.5)
+
+    def testAllTimeSamples(self):
+        c = counters.samples(name='foo',
+            types=[counters.SampleType.AVG, counters.SampleType.MAX,
+                   counters.SampleType.COUNT],
+            windows=[100, None])
+        self.assertEqual(
+            sorted(c.iterkeys()),
+            ['foo.avg', 'foo.avg.100', 'foo.count', 'foo.count.100',
+             'foo.max', 'foo.max.100'])
+
+        now = 1000000.0
+        c._now = self.mock.Mock()
+        c._now.return_value = now
+        c.add(30.0)
+        c._now.return_value = now + 50
+        c.add(10.0)
+
+        # Only the windowed samples are retained
+        self.assertEqual(len(c.samples), 2)
+
+        c._now.return_value = now + 500
+        c.add(20.0)
+        self.assertEqual(len(c.samples), 1)
+
+        self.assertEqual(c.getCounter('foo.count.100'), 1)
+        self.assertEqual(c.getCounter('foo.max.100'), 20.0)
+        self.assertEqual(c.getCounter('foo.count'), 3)
+        self.assertEqual(c.getCounter('foo.avg'), 20.0)
+        self.assertEqual(c.getCounter('foo.max'), 30.0)
+        self.assertEqual(c.getCounters()['foo.max'], 30.0)
+
+        # Windows survive binding
+        self.assertTrue(c._bind(None).all_time)
+
+    def testNumpySamples(self):
+        if not HAS_NUMPY:
+            raise Skip("numpy is required to run this test")
+        import numpy
+
+        import random
+        rng = random.Random(7)
+        types = [counters.SampleType.COUNT, counters.SampleType.SUM,
+                 counters.SampleType.AVG, counters.SampleType.MIN,
+                 counters.SampleType.MAX, counters.SampleType.P50]
+        c = counters.samples(name='foo', types=types, windows=[10, 50, None],
+                             backend='numpy', capacity=16)
+        self.assertIsInstance(c, counters.NumpySamples)
+        self.assertIn('foo.p50.10', list(c.iterkeys()))
+        c._now = self.mock.Mock()
+
+        now = 1000.0
+        history = []
+        for i in range(500):
+            now += rng.random()
+            value = float(rng.randint(-100, 100))
+            c._now.return_value = now
+            c.add(value)
+            history.append(value)
+
+        # The ring only grows as far as the largest window requires
+        self.assertLess(len(c._ts), 256)
+
+        result = c.getCounters()
+        self.assertEqual(result['foo.count'], 500)
+        self.assertEqual(result['foo.max'], max(history))
+        for window in [10, 50]:
+            ts, values = c._ordered()
+            expected = [v for t, v in zip(ts, values) if now - window <= t]
+            self.assertEqual(result['foo.count.%d' % window], len(expected))
+            self.assertAlmostEqual(result['foo.sum.%d' % window],
+                                   sum(expected))
+            self.assertEqual(c.getCounter('foo.min.%d' % window),
+                             min(expected))
+            self.assertEqual(c.getCounter('foo.p50.%d' % window),
+                             numpy.median(expected))
+
+    def testEWMA(self):
+        c = counters.ewma(name='latency', half_lives=[10, 100])
+        self.assertEqual(sorted(c.getCounters()),
+                         ['latency.ewma.10', 'latency.ewma.100'])
+        self.assertIs(c.getCounter('latency.ewma.10'), None)
+
+        c._now = self.mock.Mock()
+        c._now.return_value = 1000.0
+        c.add(100.0)
+        self.assertEqual(c.getCounter('latency.ewma.10'), 100.0)
+
+        # After one half-life, the old value has half the new one's weight
+        c._now.return_value = 1010.0
+        c.add(0.0)
+        self.assertAlmostEqual(c.getCounter('latency.ewma.10'), 50.0 / 1.5)
+        decay = 0.5 ** 0.1
+        self.assertAlmostEqual(c.getCounter('latency.ewma.100'),
+                               100.0 * decay / (decay + 1.0))
+
+    def testEWMASameTimestamp(self):
+        """Samples sharing a timestamp each count"""
+        c = counters.ewma(name='latency', half_lives=[60])
+        c._now = self.mock.Mock()
+        c._now.return_value = 1000.0
+        c.add(10.0)
+        for i in range(1000):
+            c.add(1000.0)
+        self.assertAlmostEqual(c.getCounter('latency.ewma.60'),
+                               (10.0 + 1000 * 1000.0) / 1001)
+
+        # A lone sample after idling for a half-life doesn't replace them
+        c._now.return_value = 1060.0
+        c.add(0.0)
+        self.assertAlmostEqual(c.getCounter('latency.ewma.60'),
+                               (10.0 + 1000 * 1000.0) / 2 / (1001 / 2.0 + 1))
+
+    def testDecayingRate(self):
+        c = counters.decaying_rate(name='requests', half_lives=[10])
+        self.assertEqual(c.getCounter('requests.ewma_rate.10'), 0.0)
+
+        c._now = self.mock.Mock()
+        now = 1000.0
+        for i in range(1000):
+            c._now.return_value = now + i / 10.0
+            c.increment()
+
+        # Converges on the steady 10/s rate
+        self.assertAlmostEqual(c.getCounter('requests.ewma_rate.10'), 10.0,
+                               delta=0.5)
+
+        # And halves after idling for a half-life
+        rate = c.getCounter('requests.ewma_rate.10')
+        c._now.return_value += 10
+        self.assertAlmostEqual(c.getCounter('requests.ewma_rate.10'),
+                               rate / 2)
+
+    def testDecayingRateConcurrentWriters(self):
+        """Test `counters.decaying_rate()` doesn't lose concurrent updates"""
+        import threading
+        c = counters.decaying_rate(name='requests', half_lives=[10])
+        c._now = lambda: 1000.0
+
+        def work():
+            for i in range(10000):
+                c.increment()
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # With no time elapsed, nothing has decayed
+        self.assertEqual(c._sums, [80000.0])
+
+    def testKeyedCounter(self):
+        c = counters.keyed_counter(name='requests_by_method', max_keys=3)
+        c.increment('GET')
+        c.increment('GET')
+        c.incrementBy('POST', 5)
+        c['PUT'].increment()
+        self.assertEqual(c['GET'](), 2.0)
+
+        counters_ = dict((k, v()) for k, v in c._genCounterCallbacks())
+        self.assertEqual(counters_, {
+            'requests_by_method.GET': 2.0,
+            'requests_by_method.POST': 5.0,
+            'requests_by_method.PUT': 1.0,
+        })
+
+        # POST is now the least recently updated, and is evicted
+        c.increment('DELETE')
+        self.assertEqual(sorted(c.keys()), ['DELETE', 'GET', 'PUT'])
+        self.assertEqual(c.n_evicted, 1)
+        self.assertIs(c._getCounterCallback('requests_by_method.POST')(),
+                      None)
+        self.assertIs(c._getCounterCallback('other.POST'), None)
+        self.assertEqual(c._getCounterCallback('requests_by_method.DELETE')(),
+                         1.0)
+
+    def testTopK(self):
+        import json
+        import random
+        rng = random.Random(3)
+        c = counters.top_k(name='clients', k=3, capacity=20)
+
+        # Three heavy hitters hidden in a long tail of unique keys
+        for i in range(5000):
+            r = rng.random()
+            if r < 0.2:
+                c.increment('a')
+            elif r < 0.3:
+                c.increment('b')
+            elif r < 0.35:
+                c.increment('c')
+            else:
+                c.increment('tail%d' % i)
+
+        self.assertEqual(len(c._counts), 20)
+        self.assertEqual(sorted(key for _, _, key in c._heap),
+                         sorted(c._counts))
+        top = c.top()
+        self.assertEqual([key for key, count, error in top], ['a', 'b', 'c'])
+        for key, count, error in top:
+            self.assertLessEqual(error, c.total / c.capacity)
+
+        names = sorted(k for k, v in c._genCounterCallbacks())
+        self.assertEqual(names, ['clients.a', 'clients.b', 'clients.c'])
+        self.assertEqual(c._getCounterCallback('clients.a')(), top[0][1])
+        self.assertIs(c._getCounterCallback('clients.tail1')(), None)
+
+        self.assertEqual([d['key'] for d in json.loads(c.json())],
+                         ['a', 'b', 'c'])
+
+    def testDistinct(self):
+        c = counters.distinct(name='clients', windows=[60, None])
+        self.assertEqual(sorted(c.iterkeys()),
+                         ['clients.distinct', 'clients.distinct.60'])
+        self.assertEqual(c.getCounter('clients.distinct.60'), 0)
+
+        now = 1000000.0
+        c._now = self.mock.Mock()
+        c._now.return_value = now
+        for i in range(20000):
+            c.add('10.0.%d.%d' % (i // 256, i % 256))
+            # Duplicates don't count
+            c.add(i % 100)
+
+        # ~3% standard error with the default precision
+        self.assertAlmostEqual(c.getCounter('clients.distinct.60'), 20100,
+                               delta=20100 * 0.1)
+        self.assertEqual(c.getCounter('clients.distinct'),
+                         c.getCounter('clients.distinct.60'))
+
+        # Small cardinalities are nearly exact
+        c._now.return_value = now + 120
+        for i in range(10):
+            c.add(i)
+        self.assertEqual(c.getCounter('clients.distinct.60'), 10)
+        self.assertEqual(len(c._slices[60]), 1)
+
+    def testSamplesConcurrentWriters(self):
+        """Many writer threads plus a scraper lose and tear nothing"""
+        import threading
+        c = counters.samples(name='foo',
+            types=[counters.SampleType.COUNT, counters.SampleType.SUM,
+                   counters.SampleType.MAX, counters.SampleType.P99],
+            windows=[3600, None])
+        errors = []
+        done = threading.Event()
+
+        def write():
+            for i in range(5000):
+                c.add(1.0)
+
+        def scrape():
+            try:
+                while not done.is_set():
+                    result = c.getCounters()
+                    # Each read is internally consistent
+                    self.assertEqual(result['foo.count.3600'],
+                                     result['foo.sum.3600'])
+            except Exception as e:
+                errors.append(e)
+
+        scraper = threading.Thread(target=scrape)
+        scraper.start()
+        writers = [threading.Thread(target=write) for i in range(16)]
+        for t in writers:
+            t.start()
+        for t in writers:
+            t.join()
+        done.set()
+        scraper.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(c.getCounter('foo.count.3600'), 80000)
+        self.assertEqual(c.getCounter('foo.count'), 80000)
+        self.assertEqual(c.getCounter('foo.max.3600'), 1.0)
+        self.assertEqual(len(c.samples), 80000)
+        # Buffers of exited threads are dropped once drained
+        self.assertEqual(len(c._buffers), 0)
+
+    def testBucketedSamplesConcurrentWriters(self):
+        """Threads aggregate into their own buckets, merged on read"""
+        import threading
+        c = counters.samples(name='foo',
+            types=[counters.SampleType.COUNT, counters.SampleType.SUM,
+                   counters.SampleType.MIN, counters.SampleType.MAX,
+                   counters.SampleType.P50],
+            windows=[60, None], resolution=1)
+        c._now = lambda: 1000.0
+
+        def write(n):
+            for i in range(5000):
+                c.add(float(n))
+
+        writers = [threading.Thread(target=write, args=(n, ))
+                   for n in range(1, 9)]
+        for t in writers:
+            t.start()
+        # Scraping mid-write merges (and restarts) the writers' buckets
+        c.getCounters()
+        for t in writers:
+            t.join()
+
+        self.assertEqual(c.getCounter('foo.count.60'), 40000)
+        self.assertEqual(c.getCounter('foo.sum.60'), 180000.0)
+        self.assertEqual(c.getCounter('foo.min.60'), 1.0)
+        self.assertEqual(c.getCounter('foo.max.60'), 8.0)
+        self.assertEqual(c.getCounter('foo.count'), 40000)
+        self.assertAlmostEqual(c.getCounter('foo.p50'), 4.0, delta=0.1)
+        # One bucket for the one interval, and exited threads are forgotten
+        self.assertEqual(len(c.samples), 1)
+        self.assertEqual(len(c._buffers), 0)
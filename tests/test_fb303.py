@@ -12,6 +12,8 @@ try:
 except ImportError:
     raise Skip("thrift is required to run this test")
 
+from sparts.counters import counter
+from sparts.tasks.counters import CounterSnapshotTask
 from sparts.tasks.fb303 import FB303HandlerTask
 from sparts.tasks.tornado import TornadoHTTPTask
 from sparts.tasks.tornado_thrift import TornadoThriftHandler
@@ -52,6 +54,11 @@ class TestFB303(MultiTaskTestCase):
                 server.bound_port, module=FacebookService)
         self.assertEqual(client.getStatus(), fb_status.ALIVE)
 
+    def testGetCounters(self):
+        # Must not recurse through the handler's own getCounters
+        handler = self.service.requireTask(FB303HandlerTask)
+        self.assertIsInstance(handler.getCounters(), dict)
+
     def testHTTPServerCommand(self):
         server = self.service.tasks.ThriftHTTPTask
         self.assertGreater(len(server.bound_addrs), 0)
@@ -70,3 +77,54 @@ class TestFB303(MultiTaskTestCase):
                     host=host, port=bound_addr[1],
                     path='/thrift', module=FacebookService)
             self.assertEqual(client.getStatus(), fb_status.ALIVE)
+
+
+class SlowSnapshotTask(CounterSnapshotTask):
+    # Keep the background thread out of the way; tests call execute()
+    INTERVAL = 3600.0
+
+
+class TestFB303Snapshot(MultiTaskTestCase):
+    TASKS = [FB303HandlerTask, SlowSnapshotTask]
+
+    def setUp(self):
+        super(TestFB303Snapshot, self).setUp()
+        self.handler = self.service.requireTask(FB303HandlerTask)
+        self.snapshot_task = self.service.requireTask(SlowSnapshotTask)
+        self.snapshot_task.execute()
+
+    def testSnapshotAgeIsLive(self):
+        name = 'SlowSnapshotTask.snapshot_age_ms'
+        # Subclasses of CounterSnapshotTask are used too
+        self.assertIs(self.handler._getSnapshotTask(), self.snapshot_task)
+        # Pretend the snapshot being served was taken a minute ago
+        self.snapshot_task.snapshot_time -= 60.0
+
+        self.assertGreaterEqual(self.handler.getCounters()[name], 60000)
+        self.assertGreaterEqual(self.handler.getCounter(name), 60000)
+        self.assertGreaterEqual(
+            self.handler.getSelectedCounters([name])[name], 60000)
+        self.assertGreaterEqual(
+            self.handler.getCountersSince(0).values[name], 60000)
+
+        # And resets once a new snapshot is taken
+        self.snapshot_task.execute()
+        self.assertLess(self.handler.getCounters()[name], 60000)
+
+
+class CountingFB303HandlerTask(FB303HandlerTask):
+    n_calls = counter()
+
+
+class TestFB303HandlerCounters(MultiTaskTestCase):
+    TASKS = [CountingFB303HandlerTask]
+
+    def testServiceCounters(self):
+        # The handler's counters are reachable through the service, even
+        # though it overrides getCounter(s) with the fb303 RPCs
+        name = 'CountingFB303HandlerTask.n_calls'
+        self.assertIsNotNone(self.service.getCounter(name)())
+        self.assertIn(name, self.service.getCounters())
+        self.assertIn(name, [k for k, labels, v
+                             in self.service.getCounterSeries()])
+        self.assertIn(name, self.service.getPrefixCounters(name))
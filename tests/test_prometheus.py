@@ -0,0 +1,48 @@
+# Copyright (c) 2014, Facebook, Inc.  All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+#
+from sparts import prometheus
+from sparts.counters import counter, keyed_counter, samples, SampleType
+from sparts.tests.base import BaseSpartsTestCase, SingleTaskTestCase
+from sparts.vtask import VTask
+
+
+class MetricNameTests(BaseSpartsTestCase):
+    def test_metric_name(self):
+        self.assertEqual(prometheus.metric_name('TASK.n_requests'),
+                         'TASK_n_requests')
+        self.assertEqual(prometheus.metric_name('5xx-errors'), '_5xx_errors')
+
+
+class RenderTests(SingleTaskTestCase):
+    class TASK(VTask):
+        LOOPLESS = True
+
+        n_requests = counter()
+        latency_ms = samples(windows=[60, None], types=[SampleType.AVG])
+        by_method = keyed_counter()
+
+    def test_counter_series(self):
+        series = dict(((name, tuple(sorted(labels.items()))), value)
+                      for name, labels, value
+                      in self.service.getCounterSeries())
+        self.assertIn(('TASK.n_requests', ()), series)
+        self.assertIn(('TASK.latency_ms.avg', (('window', '60'), )), series)
+        self.assertIn(('TASK.latency_ms.avg', (('window', 'all'), )), series)
+
+    def test_render(self):
+        self.task.latency_ms.add(3.0)
+        self.task.by_method.increment('GET')
+        self.task.by_method.increment('"quoted"')
+
+        lines = prometheus.render(self.service, 'svc_').splitlines()
+        self.assertIn('# TYPE svc_TASK_latency_ms_avg untyped', lines)
+        self.assertIn('svc_TASK_latency_ms_avg{window="60"} 3.0', lines)
+        self.assertIn('svc_TASK_latency_ms_avg{window="all"} 3.0', lines)
+        self.assertIn('svc_TASK_by_method{key="GET"} 1.0', lines)
+        self.assertIn('svc_TASK_by_method{key="\\"quoted\\""} 1.0', lines)
+        self.assertEqual(
+            len([l for l in lines if l.startswith('svc_TASK_n_requests ')]), 1)
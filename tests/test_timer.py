@@ -4,6 +4,7 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 #
+from sparts.counters import samples, SampleType
 from sparts.tests.base import BaseSpartsTestCase
 from sparts.timer import Timer, run_until_true
 
@@ -72,6 +73,57 @@ class TimerTests(BaseSpartsTestCase):
         t.stop()
         self.assertEqual(t.elapsed, 10.0)
 
+    def testSpans(self):
+        t = Timer()
+        t._time = self.mock.Mock()
+        t._time.return_value = 100.0
+
+        with t:
+            with t.span('parse'):
+                with t.span('tokenize'):
+                    t._time.return_value = 101.0
+                t._time.return_value = 103.0
+            with t.span('execute'):
+                t._time.return_value = 104.0
+            with t.span('parse'):
+                t._time.return_value = 104.5
+
+        self.assertEqual(list(t.spans.items()),
+                         [('parse', 3.5), ('parse.tokenize', 1.0),
+                          ('execute', 1.0)])
+        self.assertEqual(t.dump().splitlines(),
+                         ['total: 4500.000ms', '  parse: 3500.000ms',
+                          '    tokenize: 1000.000ms',
+                          '  execute: 1000.000ms'])
+
+        parse_ms = samples(types=[SampleType.MAX], windows=[60])
+        t.recordSpans({'parse': parse_ms})
+        self.assertEqual(parse_ms.getCounter('max.60'), 3500.0)
+
+    def testRestartClearsSpans(self):
+        t = Timer()
+        t._time = self.mock.Mock()
+        t._time.return_value = 100.0
+
+        t.start()
+        with t.span('parse'):
+            t._time.return_value = 101.0
+        t.stop()
+
+        # e.g., PeriodicTask restarts the same Timer every iteration
+        t.start()
+        with t.span('execute'):
+            t._time.return_value = 102.0
+        t.stop()
+
+        self.assertEqual(list(t.spans.items()), [('execute', 1.0)])
+
+    def testMonotonic(self):
+        t = Timer()
+        t.start()
+        t.stop()
+        self.assertGreaterEqual(t.elapsed, 0.0)
+
 
 class RunUntilTrueTests(BaseSpartsTestCase):
     def testTrue(self):
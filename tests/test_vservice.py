@@ -78,6 +78,39 @@ class VServiceTests(ServiceTestCase):
         self.assertContains('spam', values)
         self.assertNotContains('ham', values)
 
+    def testRegexExportedValuesIndex(self):
+        service = self.service
+        for k in ['a.1', 'a.2', 'ab', 'b.1']:
+            service.setExportedValue(k, k)
+        service.setExportedValue('a.2', None)
+        service.setExportedValue('a.1', 'one')
+
+        self.assertEqual(service._exported_keys, ['a.1', 'ab', 'b.1'])
+        self.assertEqual(service.getRegexExportedValues(r'a\..*'),
+                         {'a.1': 'one'})
+        self.assertEqual(service.getRegexExportedValues(r'a\..*'),
+                         {'a.1': 'one'})
+        self.assertEqual(sorted(service.getRegexExportedValues('.*1')),
+                         ['a.1', 'b.1'])
+
+    def testExportedValuesSince(self):
+        service = self.service
+        service.setExportedValue('foo', 'bar')
+
+        changes = service.getExportedValuesSince(0)
+        self.assertTrue(changes.full)
+        self.assertEqual(changes.values, service.getExportedValues())
+
+        service.setExportedValue('spam', 'eggs')
+        service.setExportedValue('foo', None)
+        changes = service.getExportedValuesSince(changes.cursor)
+        self.assertFalse(changes.full)
+        self.assertEqual(changes.values, {'spam': 'eggs', 'foo': None})
+
+        changes = service.getExportedValuesSince(changes.cursor)
+        self.assertFalse(changes.full)
+        self.assertEmpty(changes.values)
+
 
 class VServiceOptionTests(ServiceTestCase):
     def getServiceClass(self):
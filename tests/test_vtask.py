@@ -4,9 +4,14 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 #
-from sparts.sparts import option
-from sparts.vtask import ExecuteContext, VTask
-from sparts.tests.base import BaseSpartsTestCase, SingleTaskTestCase
+from sparts.counters import counter, keyed_counter
+from sparts.sparts import _regex_prefix, option
+from sparts.vtask import ExecuteContext, SkipTask, VTask
+from sparts.tests.base import BaseSpartsTestCase, MultiTaskTestCase, \
+    SingleTaskTestCase
+
+import threading
+import time
 
 class ExecuteContextTests(BaseSpartsTestCase):
     def test_comparisons(self):
@@ -88,3 +93,127 @@ class VTaskOptionPrefixOverrideTests(SingleTaskTestCase):
         self.assertEqual(self.task.basicopt, "foo")
         self.assertEqual(self.task.opt_uscore, "bar")
         self.assertEqual(self.task.opt_uscore2, "baz")
+
+
+class VTaskCounterTests(SingleTaskTestCase):
+    class TASK(VTask):
+        LOOPLESS = True
+
+        n_requests = counter()
+        requests_by_method = keyed_counter(max_keys=10)
+
+    def test_counters(self):
+        self.task.n_requests.increment()
+        self.task.requests_by_method.increment('GET')
+
+        counters = self.service.getCounters()
+        self.assertEqual(counters['TASK.n_requests'](), 1.0)
+        self.assertEqual(counters['TASK.requests_by_method.GET'](), 1.0)
+        self.assertEqual(
+            self.service.getCounter('TASK.requests_by_method.GET')(), 1.0)
+        self.assertIs(
+            self.service.getCounter('TASK.requests_by_method.PUT')(), None)
+
+    def test_counter_registry(self):
+        class SubTask(self.TASK):
+            n_errors = counter()
+
+        # Counters are collected once per class, including inherited ones
+        names = sorted(name for name, cb in SubTask._counter_callbacks)
+        self.assertEqual(names, ['n_errors', 'n_requests'])
+        self.assertEqual(len(SubTask._dynamic_counters), 1)
+
+        task = SubTask(self.service)
+        self.assertEqual(sorted(task.counters), ['n_errors', 'n_requests'])
+        self.assertIsNot(task.counters, SubTask(self.service).counters)
+
+    def test_counter_queries(self):
+        self.task.requests_by_method.increment('POST')
+        self.task.counters['n_callback'] = lambda: 7
+
+        names = self.service.getCounterNames()
+        self.assertEqual(names, sorted(names))
+        self.assertIn('TASK.n_callback', names)
+
+        self.assertEqual(sorted(self.service.getPrefixCounters('TASK.n_')),
+                         ['TASK.n_callback', 'TASK.n_requests'])
+        self.assertEqual(
+            sorted(self.service.getRegexCounters(r'TASK\.(n_r|req.*POST)')),
+            ['TASK.n_requests', 'TASK.requests_by_method.POST'])
+        self.assertEqual(self.service.getRegexCounters('TASK.n_cal')
+                         ['TASK.n_callback'](), 7)
+
+        selected = self.service.getSelectedCounters(['TASK.n_callback',
+                                                     'TASK.missing'])
+        self.assertEqual(selected['TASK.n_callback'](), 7)
+        self.assertIs(selected['TASK.missing'](), None)
+
+    def test_counter_names_replaced(self):
+        self.task.counters['n_old'] = lambda: 1
+        self.assertIn('TASK.n_old', self.service.getCounterNames())
+
+        # Same number of counters, but different names
+        del self.task.counters['n_old']
+        self.task.counters['n_new'] = lambda: 2
+        self.assertNotIn('TASK.n_old', self.service.getCounterNames())
+        self.assertEqual(list(self.service.getPrefixCounters('TASK.n_new')),
+                         ['TASK.n_new'])
+
+    def test_regex_prefix(self):
+        self.assertEqual(_regex_prefix(r'TASK\.n_.*'), 'TASK.n_')
+        self.assertEqual(_regex_prefix('^abc?'), 'ab')
+        self.assertEqual(_regex_prefix('a.b'), 'a')
+        self.assertEqual(_regex_prefix(r'ab\d'), 'ab')
+        self.assertEqual(_regex_prefix('ab|cd'), '')
+        self.assertEqual(_regex_prefix('(?i)ab'), '')
+
+
+class InitRecordingTask(VTask):
+    LOOPLESS = True
+
+    def initTask(self):
+        super(InitRecordingTask, self).initTask()
+        self.init_thread = threading.current_thread()
+        self.init_start = time.time()
+        time.sleep(0.2)
+        self.init_end = time.time()
+
+
+class ParallelInitSkipped(VTask):
+    LOOPLESS = True
+
+    def initTask(self):
+        raise SkipTask("skipped")
+
+
+class ParallelInitA(InitRecordingTask):
+    pass
+
+
+class ParallelInitB(InitRecordingTask):
+    DEPS = [ParallelInitSkipped]
+
+
+class ParallelInitDependent(InitRecordingTask):
+    DEPS = [ParallelInitA]
+
+
+class ParallelInitTests(MultiTaskTestCase):
+    TASKS = [ParallelInitDependent, ParallelInitB]
+
+    def getCreateArgs(self):
+        return ['--init-workers', '4']
+
+    def test_parallel_init(self):
+        a = self.service.requireTask('ParallelInitA')
+        b = self.service.requireTask('ParallelInitB')
+        dependent = self.service.requireTask('ParallelInitDependent')
+        self.assertIsNone(self.service.getTask('ParallelInitSkipped'))
+
+        # Independent tasks are initialized concurrently
+        self.assertNotEqual(a.init_thread, b.init_thread)
+        self.assertLess(a.init_start, b.init_end)
+        self.assertLess(b.init_start, a.init_end)
+
+        # ...but not before their dependencies
+        self.assertGreaterEqual(dependent.init_start, a.init_end)